@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+''' Description: Content-addressed on-disk cache of simulation outputs. Entries are keyed by a hash of the simulation arguments, the seed and the version of the simulation code, and the least recently used entries are evicted once the cache exceeds its size cap '''
+
+import hashlib
+import json
+import os
+import pickle
+
+SOURCES = ['simulation.py', 'virus.py', 'coalescent.py'] # Changing any of these invalidates the cache
+MISSING = object()
+
+def codeVersion():
+    '''Hash of the simulation source files'''
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for source in SOURCES:
+        with open(os.path.join(directory, source), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def _normalize(value):
+    '''Makes equal parameters hash equally (e.g. 1e5 and 100000, or tuples and lists). Integers stay exact; only floats with integral values become integers'''
+    if isinstance(value, bool) or value is None or isinstance(value, str):
+        return value
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else value
+    if isinstance(value, (list, tuple)):
+        return [_normalize(i) for i in value]
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for (k, v) in value.items()}
+    if hasattr(value, 'item'):
+        return _normalize(value.item())
+    return str(value)
+
+class SimulationCache:
+    def __init__(self, directory, maxBytes = 10e9):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.version = codeVersion()
+        os.makedirs(directory, exist_ok = True)
+
+    def key(self, seed, **arguments):
+        '''Cache key of a simulation. A seed is required: unseeded simulations are not reproducible and are never cached'''
+        if seed is None:
+            return None
+        payload = json.dumps({'seed': _normalize(seed), 'arguments': _normalize(arguments), 'version': self.version}, sort_keys = True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pkl')
+
+    def _load(self, key):
+        '''Cached value for key (marking it as recently used) or MISSING'''
+        if key is None:
+            return MISSING
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return MISSING
+        os.utime(path)
+        return value
+
+    def get(self, key):
+        '''Cached value for key (marking it as recently used) or None'''
+        value = self._load(key)
+        return None if value is MISSING else value
+
+    def put(self, key, value):
+        '''Stores value atomically under key and evicts least recently used entries beyond maxBytes'''
+        if key is None:
+            return
+        tmp = self._path(key) + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self._path(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pkl'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, name) in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def lookup(self, seed, **arguments):
+        '''Cached simulation for these arguments and seed, or None'''
+        return self.get(self.key(seed, **arguments))
+
+    def fetch(self, compute, seed, **arguments):
+        '''Cached simulation for these arguments and seed; on a miss it is computed with compute() and stored. Rejected (None) results are cached too'''
+        key = self.key(seed, **arguments)
+        value = self._load(key)
+        if value is MISSING:
+            value = compute()
+            self.put(key, value)
+        return value
@@ -18,6 +18,7 @@ parser.add_argument('-n', '--num', help='Number of training samples per evolutio
 parser.add_argument('-w', '--fitness', type = str, default = '', help='Fitness of positive simulations used to maintain standardized file labels.')
 parser.add_argument('-nr', '--nrows', type = int, default = 200, help='Number of aligned haplotypes.')
 parser.add_argument('-nc', '--ncols', type = int, default = 1000, help='Number of base pairs in alignment.')
+parser.add_argument('-st', '--store', default = None, help='Training store (from store.py) to read instead of the positive and neutral directories.')
 parser.add_argument('-s', '--sort', type = str, default = 'none', help='Sort columns by decreasing counts per haplotype or/and per positional counts.')
 
 args = parser.parse_args()
@@ -39,16 +40,24 @@ if sorting == 'col' or sorting == 'rowcol':
 	print('Sorted by column')
 	sortcol = True
 
-# Build training and test sets
-print('[1] Merging haplotype data \n')
-haplotypes, modes = mod.mergeData(positive_dir = pos_dir, neutral_dir = neu_dir, n = n)
+if args.store is None:
+	# Build training and test sets
+	print('[1] Merging haplotype data \n')
+	haplotypes, modes = mod.mergeData(positive_dir = pos_dir, neutral_dir = neu_dir, n = n)
 
-# Generate training and test tensors
-print('[2] Generating training and testing sets \n')
-train, test = mod.trainTestData(haplotypes = haplotypes, modes = modes, p = p, sort_row = sortrow, sort_col = sortcol)
+	# Generate training and test tensors
+	print('[2] Generating training and testing sets \n')
+	train, test = mod.trainTestData(haplotypes = haplotypes, modes = modes, p = p, sort_row = sortrow, sort_col = sortcol)
 
-haplotypes = None
-modes = None
+	haplotypes = None
+	modes = None
+else:
+	# Stream training and test sets from the store (memory use does not grow with the number of images)
+	print('[1] Splitting training store \n')
+	train_indices, test_indices = mod.splitStore(store = args.store, p = p, n = n)
+	print('[2] Streaming training and testing sets \n')
+	train = mod.storeDataset(store = args.store, indices = train_indices, sort_row = sortrow, sort_col = sortcol, shuffle = True)
+	test = mod.storeDataset(store = args.store, indices = test_indices, sort_row = sortrow, sort_col = sortcol)
 
 # Run CNN
 print('[3] Running CNN \n')
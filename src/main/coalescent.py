@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+''' Description: Backward-in-time (coalescent) sampler for the neutral class. Follows only the ancestry of the sampled haplotypes through the same growing population as simulateViralEvolution with w = 1 / probBen = 0, so neutral training images take milliseconds instead of a full forward simulation '''
+
+def populationSizes(initSize, gens, r, x, maxPopSize = 1e7):
+    '''Population size after each generation of simulateViralEvolution without selection (sizes[0] is the founding population)'''
+    sizes = [initSize]
+    for j in range(0, gens+1):
+        sizes.append(int(sizes[-1] * (r - x)))
+        if sizes[-1] == 0 or sizes[-1] > maxPopSize:
+            break
+    return sizes
+
+def sampleGenealogy(sizes, size, rng):
+    '''Draws the genealogy of size individuals sampled at the last generation. Every individual picks its parent uniformly from the previous generation, as in the forward
+    simulation. Returns ancestors[t][i], the index of the lineage ancestral to sampled individual i among the distinct lineages alive at generation t, and the number of those lineages'''
+    import numpy as np
+    ancestors = [np.arange(size)]
+    lineages = [size]
+    for t in range(len(sizes) - 1, 0, -1):
+        parents = rng.integers(0, sizes[t-1], size = lineages[-1])
+        _, inverse = np.unique(parents, return_inverse = True)
+        ancestors.append(inverse[ancestors[-1]])
+        lineages.append(int(inverse.max()) + 1)
+    return (ancestors[::-1], lineages[::-1])
+
+def simulateCoalescent(genomeSize, initSize, gens, mutRate, r, x, size, reps, maxPopSize = 1e7, sort_row = False, sort_col = False, seed = None):
+    '''Neutral haplotype images drawn backward in time. Each individual of each generation carries Poisson(mutRate) new mutations at uniform positions with uniform bases,
+    exactly as the forward simulation spreads Poisson(mutRate * N) mutations over N individuals. Returns the same (haplotypes, modes) arrays as model.sampleData; every
+    replicate is an independent population'''
+    import numpy as np
+    from model import sortHaplotypes
+    rng = np.random.default_rng(seed)
+    sizes = populationSizes(initSize, gens, r, x, maxPopSize)
+    if sizes[-1] < size:
+        raise ValueError('Final population (' + str(sizes[-1]) + ') is smaller than the sample size (' + str(size) + ')')
+    store_mode = []
+    store_haplotypes = []
+    for i in range(reps):
+        reference = rng.integers(1, 5, size = genomeSize)
+        samples = np.tile(reference, (size, 1))
+        ancestors, lineages = sampleGenealogy(sizes, size, rng)
+        # Mutations are applied forward in time so later mutations at a site overwrite earlier ones
+        for t in range(1, len(sizes)):
+            hits = rng.poisson(mutRate, size = lineages[t])
+            if hits.sum() == 0:
+                continue
+            carrier = np.repeat(np.arange(lineages[t]), hits)
+            positions = rng.integers(0, genomeSize, size = len(carrier))
+            bases = rng.integers(1, 5, size = len(carrier))
+            rows, events = np.nonzero(ancestors[t][:, None] == carrier[None, :])
+            samples[rows, positions[events]] = bases[events]
+        haplotypes = sortHaplotypes((samples != reference).astype(int), sort_row, sort_col)
+        store_mode.append('neutral')
+        store_haplotypes.append(haplotypes)
+    return (np.array(store_haplotypes), np.array(store_mode))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+''' Description: Steps of the empirical scan shared by slide.py and service.py: sliding windows over the genome, decoding of the binary encoded haplotypes,
+drawing of the subsamples with their per-window summary statistics, and the RNN classification/regression table of the subsamples '''
+
+import random
+
+def slidingSteps(genome_length = 29903, step_size = 50, buffer = 50, alignment_size = 2500):
+    '''Windows [index1, index2) of width alignment_size every step_size sites, skipping buffer sites at both ends of the genome'''
+    import math
+    steps = [(i*step_size)+buffer for i in range(0, math.floor(genome_length/step_size))]
+    steps = [[steps[i], steps[i+1]+(alignment_size - step_size)] for i in range(len(steps)-1)]
+    steps = steps + [[steps[-1][0] + genome_length - steps[-1][1] - buffer, steps[-1][1] + genome_length - steps[-1][1] - buffer]]
+    return [i for i in steps if i[1] <= genome_length]
+
+def decodeHaplotype(encoded):
+    '''Haplotype of a binary encoded file (a string of 0s and 1s) as a uint8 array'''
+    import numpy as np
+    if isinstance(encoded, str):
+        encoded = encoded.encode()
+    return np.frombuffer(encoded.rstrip(), dtype = np.uint8) - ord('0')
+
+def loadGenomes(filenames, directory, read = None):
+    '''Reads and decodes each binary encoded haplotype file once. Returns a uint8 matrix with one row per distinct file and the row of each filename.
+    read(path) replaces the decoding of a file, e.g. by a cached one'''
+    import numpy as np
+    rows = {name: k for (k, name) in enumerate(dict.fromkeys(filenames))}
+    genomes = []
+    for name in rows:
+        if read is not None:
+            genomes.append(read(directory + name))
+            continue
+        with open(directory + name, 'rb') as f:
+            genomes.append(decodeHaplotype(f.read()))
+    if len(set(len(i) for i in genomes)) > 1:
+        raise ValueError('Haplotype files in ' + directory + ' have different lengths')
+    return (np.array(genomes), rows)
+
+def drawSubsamples(matrix, rows, filenames, steps, number_subsamples = 25, size = 200, legacy = False, rng = random, verbose = True):
+    '''Draws number_subsamples subsamples of size haplotypes among filenames (with replacement when there are fewer than size) and removes their fixed sites.
+    Returns the (subsamples, size, sites) array and the Tajima's D and Fay and Wu's H of every window in steps, from prefix sums of the per-site counts'''
+    import numpy as np
+    from stats import windowStats
+    filenames = list(filenames)
+    subsamples, tajD, wuH = [], [], []
+    for j in range(number_subsamples):
+        if verbose:
+            print('Subsample ' + str(j))
+        if len(filenames) < size:
+            drawn = rng.choices(filenames, k = size)
+        else:
+            drawn = rng.sample(filenames, k = size)
+        genomes = matrix[[rows[i] for i in drawn]]
+        genomes[:,np.where(np.sum(genomes, axis = 0) == size)[0]] = 0 # Remove fixed sites
+        sumstats = windowStats(np.sum(genomes, axis = 0), steps, n = size, legacy = legacy, empty = (-3, 0))
+        tajD.append(sumstats['tajimas_d'].tolist())
+        wuH.append(sumstats['fay_wu_h'].tolist())
+        subsamples.append(genomes)
+    return (np.array(subsamples), np.array(tajD), np.array(wuH))
+
+def predictSubsamples(classification, ensemble, scores, tajD, wuH):
+    '''Table written by slide.py: RNN classification (CNN scores and Fay and Wu's H) and ensemble regression of each subsample, from its per-window features'''
+    import numpy as np
+    import pandas as pd
+    rnn_classification = classification.predict(np.stack([scores, wuH], axis = -1))[:,0].tolist()
+    rnn_regression = ensemble.predict(tajD = tajD, wuH = wuH, CNN = scores).tolist()
+    return pd.DataFrame({'n_subsample': [i for i in range(len(scores))], 'rnn_classification': rnn_classification, 'rnn_regression': rnn_regression})
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+''' Description: RNN regression ensemble used on empirical scans. The LSTMs and the GradientBoosting stage (rnn_ensemble.joblib) are loaded once, and every
+subsample is scored with one batched call per model, or with a single call to the fused export of all LSTMs (fuseEnsemble) '''
+
+import argparse
+import json
+import tensorflow as tf
+
+RNN_MODELS = ['0.0_tajD', '0.001_tajD_CNN', '0.002_CNN', '0.0_wuH_CNN', '0.003_CNN', '0.0_CNN', '0.0_multi', '0.0_tajD_CNN', '0.0_tajD_wuH', '0.001_tajD']
+FEATURES = ['CNN', 'wuH', 'tajD'] # Column order of the per-window features the LSTMs were trained on (process_sim.py)
+
+def featureLayout(name):
+    '''Per-window features (in input column order) of the model with identifier name, e.g. 0.001_tajD_CNN -> [CNN, tajD]; multi uses all of them'''
+    if 'multi' in name:
+        return list(FEATURES)
+    return [feature for feature in FEATURES if feature in name]
+
+@tf.keras.utils.register_keras_serializable(package = 'ImHapE')
+class SelectFeatures(tf.keras.layers.Layer):
+    '''Keeps the given columns of the last axis of its input'''
+    def __init__(self, columns, **kwargs):
+        super().__init__(**kwargs)
+        self.columns = list(columns)
+
+    def call(self, inputs):
+        return tf.gather(inputs, self.columns, axis = -1)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'columns': self.columns})
+        return config
+
+def fuseEnsemble(model_directory, rnn_models = RNN_MODELS, output = None):
+    '''Merges the regression LSTMs into one Keras model with a single (windows, features) input in FEATURES order. Each LSTM reads its own columns through
+    SelectFeatures, and the outputs are concatenated in rnn_models order (the columns rnn_ensemble.joblib expects). Saved to output with the model order in output.json'''
+    inputs = tf.keras.Input(shape = (None, len(FEATURES)), name = 'features')
+    outputs = []
+    for name in rnn_models:
+        model = tf.keras.models.load_model(model_directory + 'regression_' + name + '_rnn.tf')
+        model._name = 'regression_' + name.replace('.', '_') # Every loaded LSTM is called sequential; nested models need unique names
+        outputs.append(model(SelectFeatures([FEATURES.index(feature) for feature in featureLayout(name)], name = 'select_' + name.replace('.', '_'))(inputs)))
+    fused = tf.keras.Model(inputs, tf.keras.layers.Concatenate(name = 'regressions')(outputs), name = 'rnn_ensemble')
+    if output is not None:
+        tf.keras.models.save_model(fused, filepath = output)
+        with open(output + '.json', 'w') as f:
+            json.dump(list(rnn_models), f)
+    return fused
+
+class EnsemblePredictor:
+    def __init__(self, model_directory, rnn_models = RNN_MODELS, fused = None):
+        from joblib import load
+        self.ensembled = load(model_directory + 'rnn_ensemble.joblib')
+        self.models = {}
+        self.fused = None
+        if fused is not None:
+            print('Loading ' + fused)
+            self.fused = tf.keras.models.load_model(fused)
+            with open(fused + '.json') as f:
+                self.rnn_models = json.load(f)
+            return
+        self.rnn_models = list(rnn_models)
+        for name in self.rnn_models:
+            print('Loading regression_' + name + '_rnn.tf')
+            self.models[name] = tf.keras.models.load_model(model_directory + 'regression_' + name + '_rnn.tf')
+
+    def features(self, name, tajD, wuH, CNN):
+        '''Input of model name: a (subsamples, windows, features) array'''
+        import numpy as np
+        values = {'CNN': CNN, 'wuH': wuH, 'tajD': tajD}
+        return np.stack([np.atleast_2d(np.asarray(values[feature], dtype = float)) for feature in featureLayout(name)], axis = -1)
+
+    def regressions(self, tajD, wuH, CNN):
+        '''Prediction of every LSTM for every subsample, as a DataFrame with one column per model (the input of the GradientBoosting stage)'''
+        import pandas as pd
+        if self.fused is not None:
+            return pd.DataFrame(self.fused.predict(self.features('multi', tajD, wuH, CNN)), columns = self.rnn_models)
+        df = pd.DataFrame({})
+        for name in self.rnn_models:
+            df[name] = self.models[name].predict(self.features(name, tajD, wuH, CNN))[:,0]
+        return df
+
+    def predict(self, tajD, wuH, CNN):
+        '''Ensemble regression for each subsample. tajD, wuH and CNN are per-window features of one subsample (windows) or of many (subsamples, windows)'''
+        return self.ensembled.predict(self.regressions(tajD, wuH, CNN))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Exports the RNN regression ensemble as one fused Keras model')
+    parser.add_argument('-d', '--model_directory', help='Directory containing the regression LSTMs (regression_<id>_rnn.tf)')
+    parser.add_argument('-out', '--output', help='Path of the fused model')
+    # Example argument
+    # - python3 ensemble.py -d models/ -out models/fused_rnn.tf
+    args = parser.parse_args()
+    fuseEnsemble(args.model_directory, output = args.output)
+    print('Saved ' + args.output + ' (models in ' + args.output + '.json)')
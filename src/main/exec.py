@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 ''' Description: This script performs simulations of viral evolution using specified parameters such as replication rate, death rate, fitness, etc. '''
 
-from simulation import simulateViralEvolution
+from simulation import simulateViralEvolution, simulateViralEvolutionVectorized, simulateViralEvolutionClones, loadSnapshot
 import model as mod
+from coalescent import simulateCoalescent, populationSizes
+from cache import SimulationCache
+import hashlib
 import numpy as np
 import argparse
 import random
 import time
+import os
+from concurrent.futures import ProcessPoolExecutor
 from virus import Virus, Population
 from copy import deepcopy,copy
 
@@ -27,56 +32,205 @@ parser.add_argument('-out', '--output', help='Output directory')
 parser.add_argument('-max', '--max_mutations', type = int, default = 1000, help='Maximum number of mutations per aligned haplotype block.')
 parser.add_argument('-min', '--min_mutations', type = int, default = 10, help='Minimum number of mutations per aligned haplotype block.')
 parser.add_argument('-sort', '--sort', default = 'none', help='Sort rows or columns')
+parser.add_argument('-wk', '--workers', default = 1, type = int, help='Number of worker processes running simulations in parallel.')
+parser.add_argument('-seed', '--seed', default = None, type = int, help='Seed for the batch. Each simulation gets its own stream derived from it, so output does not depend on the number of workers.')
+parser.add_argument('-es', '--early_stop', action = 'store_true', help='Abandon a simulation as soon as it is unlikely to give an image within the mutation limits (population extinct, expected segregating sites of an image well above the maximum, or growth stalled well below the minimum).')
+parser.add_argument('-rs', '--resume', default = None, help='Snapshot (from snapshotGen/snapshotPath) that every simulation continues from with the parameters given here. Engine, genome size and initial size are taken from the snapshot.')
+parser.add_argument('-ws', '--windowSize', default = None, type = int, help='Cut images of this many bp from each (full-genome) simulation instead of saving one image of the whole genome.')
+parser.add_argument('-wst', '--windowStep', default = None, type = int, help='Step between windows (defaults to the window size, i.e. non-overlapping windows).')
+parser.add_argument('-wr', '--windowReps', default = 1, type = int, help='Number of row subsamples to cut windows from per simulation.')
+parser.add_argument('-c', '--cache', default = None, help='Directory of the simulation cache. Simulations already run with the same parameters, seed and code are loaded instead of rerun.')
+parser.add_argument('-cs', '--cache_size', default = 10, type = float, help='Size cap of the simulation cache (GB); least recently used simulations are evicted beyond it.')
+parser.add_argument('-fmt', '--format', default = 'packed', help='Image format: packed (one bit per site in .npz, with the simulation parameters) or npy (int array, as in earlier versions)')
+parser.add_argument('-e', '--engine', default = 'object', help='Simulation engine: object (one Virus per individual), vectorized (genotype table), clone (clone counts, for populations of 1e7+) or coalescent (backward-in-time sampler, neutral simulations only)')
 
 # Example argument
 # - python3 exec.py -r 2.02 -w 1.1 -x 1 -p 0.01 -u 1e-2 -i 110 -gs 1000 -g 250 -ms 1e5 -n 1 -out test
+# - python3 exec.py -r 2.02 -w 1.1 -x 1 -p 0.01 -u 1e-2 -i 110 -gs 1000 -g 250 -ms 1e5 -n 500 -e vectorized -wk 16 -seed 42 -out test
+# - python3 exec.py -r 2.02 -w 1.1 -x 1 -p 0.01 -u 1e-2 -i 110 -gs 29903 -g 250 -ms 1e5 -n 20 -e vectorized -ws 2500 -wr 5 -out test
+# - python3 exec.py -r 2.02 -w 1.1 -x 1 -p 0.01 -u 1e-2 -i 110 -gs 1000 -g 250 -ms 1e5 -n 500 -e vectorized -seed 42 -c cache/ -out test
 
-args = parser.parse_args()
-r = args.rep_rate
-w = args.fitness
-x = args.death_rate
-p = args.probBen
-u = args.mutRate
-gs = args.genomeSize
-g = args.gens
-i = args.initSize
-ims = args.imageSize
-ms = int(args.maxPopSize)
-n = args.numberSims
-out = str(args.output)
-max_muts = args.max_mutations
-min_muts = args.min_mutations
-sort = str(args.sort)
-
-if sort == 'row':
-	sortrow, sortcol = (True, False)
-elif sort == 'col':
-	sortrow, sortcol = (False, True)
-elif sort == 'row_col':
-	sortrow, sortcol = (True, True)
-else:
-	sortrow, sortcol = (False, False)
-
-randid = str(random.randint(1, 1e7)) # Assign random id to for saving simulations
-
-for val in range(n):
-
-	# Run simulations
-	print('[1] Simulation started \n')
-	sim = simulateViralEvolution(r = r, w = w, x = x, probBen = p, mutRate = u, genomeSize = gs, initSize = i, gens = g, maxPopSize = ms, print_per_gen = 10)
-	
-	# Only accept simulations with sufficient mutations across each aligned haplotypes
-	print('[2] Extracting haplotype sample \n')
-	haplotypes, modes = mod.sampleData(sims = sim, size = ims, reps = 1, sort_row = sortrow, sort_col = sortcol)
-
-	# Simulation names
-	if w > 1:
-		name = w
+ENGINES = {'object': simulateViralEvolution, 'vectorized': simulateViralEvolutionVectorized, 'clone': simulateViralEvolutionClones, 'coalescent': simulateCoalescent}
+
+def saveAtomic(path, array, packed = True, **metadata):
+	'''Writes array to path + .npz (bit-packed, see model.saveHaplotypes) or path + .npy through a temporary file so readers never see a partial image'''
+	tmp = path + '.' + str(os.getpid()) + '.tmp'
+	with open(tmp, 'wb') as f:
+		if packed:
+			mod.saveHaplotypes(f, array, **metadata)
+		else:
+			np.save(f, array)
+	os.replace(tmp, path + ('.npz' if packed else '.npy'))
+	return path + ('.npz' if packed else '.npy')
+
+def earlyStop(min_muts, max_muts, size, every = 10, patience = 10):
+	'''Stopping rule for simulateViralEvolution. Every few generations the expected number of segregating sites in an image of size haplotypes is computed from the population
+	site frequencies; the simulation is abandoned if the population is extinct, if that expectation is already well above max_muts, or if growth has stalled well below min_muts'''
+	history = []
+	def stop(generation, popsize, frequencies):
+		history.append(popsize)
+		if popsize == 0:
+			return True
+		if generation % every != 0:
+			return False
+		f = frequencies()
+		expected = np.sum(1 - (1 - f) ** size - f ** size)
+		if expected > 2 * max_muts:
+			return True
+		stalled = len(history) > patience and history[-1] <= history[-1 - patience]
+		return stalled and expected < min_muts / 2
+	return stop
+
+def segregatingSites(haplotypes):
+	'''Number of segregating sites in each image'''
+	counts = np.sum(haplotypes, axis = 1)
+	return np.sum((counts > 0) & (counts < haplotypes.shape[1]), axis = 1)
+
+def fileHash(path):
+	'''sha256 of a file, so cache keys follow the contents of a snapshot rather than its name'''
+	digest = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+def runSimulation(task):
+	'''Runs simulation number val of the batch with random streams derived only from (seed, val) and saves each sampled image whose segregating sites are within [min_muts, max_muts].
+	Returns a list of (path, outcome) per image with outcome one of accepted, too_few, too_many or stopped'''
+	val, seed, params = task
+	sim_stream, sample_stream = np.random.SeedSequence(entropy = seed, spawn_key = (val,)).spawn(2)
+	kwargs = dict(r = params['r'], w = params['w'], x = params['x'], probBen = params['p'], mutRate = params['u'], genomeSize = params['gs'], initSize = params['i'], gens = params['g'], maxPopSize = params['ms'], print_per_gen = params['print_per_gen'])
+	if params['early_stop']:
+		kwargs['stop'] = earlyStop(params['min_muts'], params['max_muts'], params['ims'])
+	if params['resume'] is not None:
+		kwargs['resume'] = params['resume']
+
+	def simulate():
+		if params['engine'] == 'coalescent':
+			return simulateCoalescent(genomeSize = params['gs'], initSize = params['i'], gens = params['g'], mutRate = params['u'], r = params['r'], x = params['x'], size = params['ims'], reps = 1, maxPopSize = params['ms'], seed = sim_stream) # Sorted after the cache lookup, like the forward engines
+		elif params['engine'] == 'object':
+			random.seed(int(sim_stream.generate_state(1)[0]))
+			np.random.seed(sim_stream.generate_state(1))
+			return simulateViralEvolution(**kwargs)
+		elif params['engine'] == 'vectorized':
+			return simulateViralEvolutionVectorized(seed = sim_stream, genealogy = True, **kwargs)
+		else:
+			return ENGINES[params['engine']](seed = sim_stream, **kwargs)
+
+	# Run simulations (or load them from the cache)
+	print('[1] Simulation ' + str(val) + ' started \n')
+	if params['cache'] is None:
+		sim = simulate()
+	else:
+		cache = SimulationCache(params['cache'], params['cache_size'])
+		arguments = {k: v for (k, v) in kwargs.items() if k not in ['stop', 'print_per_gen', 'resume']}
+		stop = [params['min_muts'], params['max_muts'], params['ims']] if params['early_stop'] else None
+		sample = [params['ims']] if params['engine'] == 'coalescent' else None
+		sim = cache.fetch(simulate, [seed, val], engine = params['engine'], stop = stop, resume = params['resume_hash'], sample = sample, **arguments)
+
+	# Sampling draws from its own stream, so cached and fresh simulations give the same images
+	random.seed(int(sample_stream.generate_state(1)[0]))
+	np.random.seed(sample_stream.generate_state(1))
+	if params['engine'] == 'coalescent':
+		haplotypes, modes = sim
+		haplotypes = mod.sortHaplotypes(haplotypes, params['sortrow'], params['sortcol'])
+		ids, size, starts = [str(val)], params['gs'], [0]
+	else:
+		if sim is None or sim.mutations.shape[0] < params['ims']:
+			return [(None, 'stopped')]
+		if params['window'] is None:
+			print('[2] Extracting haplotype sample ' + str(val) + ' \n')
+			haplotypes, modes = mod.sampleData(sims = sim, size = params['ims'], reps = 1, sort_row = params['sortrow'], sort_col = params['sortcol'])
+			ids, size, starts = [str(val)], params['gs'], [0]
+		else:
+			print('[2] Extracting haplotype windows ' + str(val) + ' \n')
+			haplotypes, modes, starts = mod.sampleWindows(sims = sim, size = params['ims'], reps = params['window_reps'], window = params['window'], step = params['window_step'], sort_row = params['sortrow'], sort_col = params['sortcol'])
+			ids, size = [str(val) + '-' + str(k) for k in range(len(haplotypes))], params['window']
+
+	# Only accept images with sufficient mutations across each aligned haplotypes
+	results = []
+	for image, mode, id_, start, sites in zip(haplotypes, modes, ids, starts, segregatingSites(haplotypes)):
+		if sites < params['min_muts']:
+			results.append((None, 'too_few'))
+			continue
+		if sites > params['max_muts']:
+			results.append((None, 'too_many'))
+			continue
+
+		# Simulation names (windows without a beneficial mutation are labelled neutral)
+		if mode != 'neutral':
+			name = params['w']
+		else:
+			name = 1
+
+		path = params['out'] + str(size) + '_' + str(params['u']) + '_' + str(params['p']) + '_' + str(name) + '_' + str(seed) + '_' + id_
+		metadata = dict(r = params['r'], w = params['w'], x = params['x'], p = params['p'], u = params['u'], gs = params['gs'], g = params['g'], i = params['i'], ms = params['ms'], engine = params['engine'], seed = seed, val = val, mode = str(mode), start = int(start), sortrow = params['sortrow'], sortcol = params['sortcol'])
+		path = saveAtomic(path, image.reshape((1,) + image.shape), packed = params['format'] == 'packed', **metadata)
+		results.append((path, 'accepted'))
+	return results
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+	sort = str(args.sort)
+	engine = str(args.engine)
+	workers = args.workers
+
+	if sort == 'row':
+		sortrow, sortcol = (True, False)
+	elif sort == 'col':
+		sortrow, sortcol = (False, True)
+	elif sort == 'row_col':
+		sortrow, sortcol = (True, True)
 	else:
-		name = 1
+		sortrow, sortcol = (False, False)
 
-	np.save(out + str(gs) + '_' + str(u) + '_' + str(p) + '_' + str(name) + '_' + randid + '_' + str(val), haplotypes)
+	genomeSize, initSize = args.genomeSize, args.initSize
+	if args.resume is not None:
+		snapshot = loadSnapshot(args.resume)
+		engine, genomeSize, initSize = snapshot['engine'], snapshot['params']['genomeSize'], snapshot['params']['initSize']
+		print('Continuing from generation ' + str(snapshot['generation']) + ' of ' + args.resume)
+
+	if engine not in ENGINES:
+		parser.error('Unknown engine: ' + engine)
+	if args.format not in ['packed', 'npy']:
+		parser.error('Unknown image format: ' + args.format)
+	if engine == 'coalescent' and (args.fitness != 1 and args.probBen != 0):
+		parser.error('The coalescent engine only simulates the neutral class (-w 1 or -p 0)')
+	if engine == 'coalescent' and (args.windowSize is not None or args.early_stop):
+		parser.error('Windows and early stopping need a forward simulation engine')
+	if args.windowSize is not None and not 0 < args.windowSize <= genomeSize:
+		parser.error('The window size (' + str(args.windowSize) + ') must be between 1 and the genome size (' + str(genomeSize) + ')')
+	if args.windowStep is not None and args.windowStep <= 0:
+		parser.error('The window step must be positive')
+	if engine == 'coalescent':
+		finalSize = populationSizes(initSize, args.gens, args.rep_rate, args.death_rate, int(args.maxPopSize))[-1] # Deterministic without selection
+		if finalSize < args.imageSize:
+			parser.error('The final population (' + str(finalSize) + ') is smaller than the image size (' + str(args.imageSize) + ')')
+
+	# Seed of the batch doubles as the id used for saving simulations
+	seed = args.seed if args.seed is not None else random.SystemRandom().randint(1, int(1e7))
+	print('Batch seed: ' + str(seed))
+
+	params = dict(r = args.rep_rate, w = args.fitness, x = args.death_rate, p = args.probBen, u = args.mutRate, gs = genomeSize, g = args.gens, i = initSize, ims = args.imageSize, ms = int(args.maxPopSize), out = str(args.output), max_muts = args.max_mutations, min_muts = args.min_mutations, sortrow = sortrow, sortcol = sortcol, early_stop = args.early_stop, window = args.windowSize, window_step = args.windowStep, window_reps = args.windowReps, resume = args.resume, resume_hash = None if args.resume is None else fileHash(args.resume), cache = args.cache, cache_size = args.cache_size * 1e9, format = args.format, engine = engine, print_per_gen = 10 if workers <= 1 else -1)
+	tasks = [(val, seed, params) for val in range(args.numberSims)]
+
+	start_time = time.time()
+	outcomes = {'accepted': 0, 'too_few': 0, 'too_many': 0, 'stopped': 0}
+	if workers <= 1:
+		results = map(runSimulation, tasks)
+	else:
+		pool = ProcessPoolExecutor(max_workers = workers)
+		results = pool.map(runSimulation, tasks)
+	for images in results:
+		for path, outcome in images:
+			outcomes[outcome] += 1
+			if path is not None and workers > 1:
+				print('Saved ' + path)
+	if workers > 1:
+		pool.shutdown()
 
-	sim = None
-	haplotypes = None
-	modes = None
+	# Rejection summary for the batch
+	total = sum(outcomes.values())
+	rejected = total - outcomes['accepted']
+	print('Finished ' + str(len(tasks)) + ' simulations in ' + str(round(time.time() - start_time, 2)) + ' seconds')
+	print('Rejected ' + str(rejected) + '/' + str(total) + ' images (' + str(round(100 * rejected / max(total, 1), 1)) + '%): ' + str(outcomes['too_few']) + ' below ' + str(args.min_mutations) + ' segregating sites, ' + str(outcomes['too_many']) + ' above ' + str(args.max_mutations) + ', ' + str(outcomes['stopped']) + ' stopped early or too small to sample')
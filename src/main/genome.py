@@ -3,7 +3,7 @@
 
 # Import modules 
 from simulation import simulateViralEvolution
-import model as mod
+from cache import SimulationCache
 import numpy as np
 import argparse
 import random
@@ -14,7 +14,8 @@ import math
 import random
 import pandas as pd
 import tensorflow as tf
-from itertools import combinations
+from stats import windowStats
+from scan import scanWindows, scanConvolutional
 
 # Arguments
 parser = argparse.ArgumentParser(description = 'Simulation parameters')
@@ -25,6 +26,13 @@ parser.add_argument('-as', '--alignment_size', default=1000, help = 'Alignment s
 parser.add_argument('-out', '--out', help='Output directory. Requires / at the end.')
 parser.add_argument('-p', '--pb', default = 0.1, help='Probability of mutation being beneficial.')
 parser.add_argument('-s', '--sort', default = 0.1, help='Sort the haplotypes.')
+parser.add_argument('-wk', '--workers', default = 2, type = int, help='Threads slicing and sorting window images ahead of the CNN (0 to build them serially).')
+parser.add_argument('-qd', '--queue_depth', default = 2, type = int, help='Maximum number of window batches prepared ahead of the CNN.')
+parser.add_argument('-ls', '--legacy_stats', action = 'store_true', help='Compute Tajima\'s D and Fay and Wu\'s H as earlier versions did (pi scaled by n^2 as XOR), to match RNNs trained on those features.')
+parser.add_argument('-fc', '--fully_convolutional', action = 'store_true', help='Run the CNN trunk once over the whole genome instead of once per window (unsorted or row sorted images only; rows are then sorted over the whole genome rather than per window).')
+parser.add_argument('-seed', '--seed', default = None, type = int, help='Seed of the simulation and sampling (also used as the id of the output files).')
+parser.add_argument('-c', '--cache', default = None, help='Directory of the simulation cache (only used with --seed).')
+parser.add_argument('-cs', '--cache_size', default = 10, type = float, help='Size cap of the simulation cache (GB).')
 
 # Set parameters
 args = parser.parse_args()
@@ -39,57 +47,40 @@ FITNESS = float(args.fitness)
 PROB_BEN = float(args.pb)
 MUTRATE = float(args.mutrate)
 SORTING = args.sort
-
-# Function
-# --------
-def popgenStats(haplotypes, n = 200):
-	counts = np.array([i for i in np.sum(haplotypes, axis = 0) if i < 200 and i > 0])
-	# Watterson's estimator
-	S = len(counts)
-	if S > 0:
-		an = np.sum([1/i for i in range(1, n)])
-		theta_w = S / an
-		# Tajima's pi
-		vafs = counts / n
-		d = np.sum(vafs * (1 - vafs)) * (n^2)
-		theta_pi = d / len([j for j in combinations([i for i in range(n)], 2)])
-		# Variance for Tajima's D
-		a1 = np.sum([1/i for i in range(1, n)])
-		a2 = np.sum([1/(i*i) for i in range(1, n)])
-		b1 = (n + 1) / (3 * (n - 1))
-		b2 = (2 * ((n*n) + n + 3)) / (9 * n * (n - 1))
-		c1 = b1 - (1 / a1)
-		c2 = b2 - ((n + 2) / (a1 * n)) + (a2 / (a1*a1))
-		e1 = c1 / a1
-		e2 = c2 / ((a1*a1) + a2)
-		seD = np.sqrt((e1 *S) + ((e2 * S) * (S - 1)))
-		TajimasD = (theta_pi - theta_w) / seD
-		# Fay and Wu's H
-		theta_l = np.sum(vafs) * (n / (n - 1))
-		bn = np.sum([1/(i*i) for i in range(1, n)])
-		bn1 = np.sum([1/(i*i) for i in range(1, n+1)])
-		theta2 = (S * (S - 1)) / ((an*an) + bn)
-		seH = np.sqrt((((n - 2) / (6*(n - 1))) * theta_w) + (theta2 * (((18 * (n*n) * (3 * n + 2) * bn1) - (88 * (n*n*n) + 9 * (n*n) - 13*n + 6))/(9 * n * ((n - 1)*(n-1))))))
-		WuH = 2 * ((theta_pi - theta_l) / seH)
-	else:
-		TajimasD, WuH = 0, 0
-	return [TajimasD, WuH]
+LEGACY_STATS = args.legacy_stats
+WORKERS = args.workers
+QUEUE_DEPTH = args.queue_depth
+if args.fully_convolutional and (SORTING == 'col' or SORTING == 'rowcol'):
+	parser.error('The fully-convolutional scan cannot sort columns')
 
 # Run simulation at fitness of 1.1
 # --------------------------------
 print('[1] Simulating data.....')
-randid = str(random.randint(1, 1e7)) # Assign random id to for saving simulations
-sim = simulateViralEvolution(r = 2.05, w = FITNESS, x = 1, probBen = PROB_BEN, mutRate = MUTRATE, initSize = 110, genomeSize = GENOME_LENGTH, gens = 250, maxPopSize = 1e5)
+randid = str(random.randint(1, 1e7)) if args.seed is None else str(args.seed) # Assign random id to for saving simulations
+arguments = dict(r = 2.05, w = FITNESS, x = 1, probBen = PROB_BEN, mutRate = MUTRATE, initSize = 110, genomeSize = GENOME_LENGTH, gens = 250, maxPopSize = 1e5)
+if args.seed is not None:
+	random.seed(args.seed)
+	np.random.seed(args.seed)
+if args.cache is not None and args.seed is not None:
+	sim = SimulationCache(args.cache, args.cache_size * 1e9).fetch(lambda: simulateViralEvolution(**arguments), args.seed, engine = 'object', **arguments)
+else:
+	sim = simulateViralEvolution(**arguments)
+if args.seed is not None:
+	# Sampling is reseeded so cached and fresh simulations give the same windows
+	random.seed(args.seed + 1)
+	np.random.seed(args.seed + 1)
 
 # Sample haplotypes and compute frequencies for positive loci
 # -----------------------------------------------------------
-haplotypes, modes = mod.sampleData(sims = sim, size = 1000, reps = 1, sort_row = False, sort_col = False)
+# Only the sampled rows (and requested columns) are ever materialized
+sample_rows = np.random.choice(sim.mutations.shape[0], size = 1000, replace = False)
+reference = np.array(sim.reference)
 positiveLoci = sim.positiveLoci
 neutralLoci = sim.neutralLoci
-positiveFreq = np.sum(np.array(haplotypes[0][:,positiveLoci]), axis = 0)/1000
-neutralFreq = np.sum(np.array(haplotypes[0][:,neutralLoci]), axis = 0)/1000
+positiveFreq = np.sum(sim.dense(sample_rows, positiveLoci) != reference[positiveLoci], axis = 0)/1000
+neutralFreq = np.sum(sim.dense(sample_rows, neutralLoci) != reference[neutralLoci], axis = 0)/1000
 
-counts_per_virus = np.sum(np.array(haplotypes)[0], axis = 1)
+counts_per_virus = np.sum([np.sum(sim.dense(sample_rows, slice(k, k + 5000)) != reference[k:k + 5000], axis = 1) for k in range(0, GENOME_LENGTH, 5000)], axis = 0)
 np.save(OUTPUT_DIRECTORY + str(SORTING) + '_' + str(ALIGNMENT_SIZE) + '_' + 'simgenome_' + str(FITNESS) + '_' + str(PROB_BEN) + '_' + str(MUTRATE) + '_counts_' + str(randid), counts_per_virus)
 
 
@@ -103,32 +94,18 @@ steps = [i for i in steps if i[1] <= GENOME_LENGTH]
 hapCNN = tf.keras.models.load_model(MODEL)
 
 print('[2] Performing slide window analysis.....')
-# Run CNN over subsamples across steps
-index1, index2, upper, mean, lower, tajimasD, fayandwuH = [], [], [], [], [], [], []
-for i1, i2 in steps:
-	print('[----] On to step: ' + str(i2))
-	scores = []
-	store = []
-	for i in range(NUMBER_SUBSAMPLES):
-		print('Subsample ' + str(i))
-		row_index = random.sample([i for i in range(haplotypes[0].shape[0])], k = 200)
-		haplotypeSample = haplotypes[0][row_index,i1:i2]
-		print(' - Number mutations in alignment: ' + str(np.sum(haplotypeSample)))
-		if SORTING == 'row' or SORTING == 'rowcol':
-			haplotypeSample = np.array(haplotypeSample[np.argsort(haplotypeSample.sum(axis=1))[::-1],:].tolist())
-		if SORTING == 'col' or SORTING == 'rowcol':
-			haplotypeSample = np.array(haplotypeSample[:,np.argsort(haplotypeSample.sum(axis=0))[::-1]].tolist())
-		store.append(haplotypeSample)
-	store = np.array(store)
-	tajimasD = tajimasD + [np.mean([popgenStats(k)[0] for k in store])]
-	fayandwuH = fayandwuH + [np.mean([popgenStats(k)[1] for k in store])]
-	store = store.reshape(store.shape + (1,))
-	scores = hapCNN.predict(store)
-	upper = upper + [np.quantile(scores, 0.975)]
-	mean = mean + [np.mean(scores)]
-	lower = lower + [np.quantile(scores, 0.025)]
-	index1 = index1 + [i1]
-	index2 = index2 + [i2]
+# Subsamples are drawn once per scan; Tajima's D and Fay and Wu's H of every window come from prefix sums of their per-site counts
+subsamples = np.array([(sim.dense(sample_rows[random.sample([i for i in range(len(sample_rows))], k = 200)]) != reference).astype(np.uint8) for i in range(NUMBER_SUBSAMPLES)])
+sumstats = windowStats(subsamples.sum(axis = 1, dtype = np.int64), steps, legacy = LEGACY_STATS, empty = (0, 0))
+tajimasD, fayandwuH = np.mean(sumstats['tajimas_d'], axis = 0).tolist(), np.mean(sumstats['fay_wu_h'], axis = 0).tolist()
+
+# Run CNN over subsamples across steps (one batched pass over every window of every subsample)
+if args.fully_convolutional:
+	scores = scanConvolutional(hapCNN, subsamples, steps, sort_row = SORTING == 'row')
+else:
+	scores = scanWindows(hapCNN, subsamples, steps, sort_row = SORTING == 'row' or SORTING == 'rowcol', sort_col = SORTING == 'col' or SORTING == 'rowcol', workers = WORKERS, depth = QUEUE_DEPTH)
+index1, index2 = [i1 for i1, i2 in steps], [i2 for i1, i2 in steps]
+upper, mean, lower = np.quantile(scores, 0.975, axis = 0).tolist(), np.mean(scores, axis = 0).tolist(), np.quantile(scores, 0.025, axis = 0).tolist()
 
 output = pd.DataFrame({'index1': index1, 'index2':index2, 'upper':upper, 'mean':mean, 'lower':lower, 'Tajima\'s D':tajimasD, 'Fay and Wu\'s H':fayandwuH})
 output.to_csv(OUTPUT_DIRECTORY + str(SORTING) + '_' + str(ALIGNMENT_SIZE) + '_' + 'simgenome_' + str(FITNESS) + '_' + str(PROB_BEN) + '_' + str(MUTRATE) + '_predictions_' + str(randid) + '.csv', index = False)
@@ -1,76 +1,141 @@
 #!/usr/bin/env python3
-''' Description: This script contains functions relevant to sampling simulated haplotypes (sampleData), merging neutral and positive simulations (mergeData), and training CNN (trainTestData and trainCNN) '''
+''' Description: This script contains functions relevant to sorting (sortHaplotypes) and sampling simulated haplotypes (sampleData and sampleWindows), saving and loading bit-packed haplotype images (saveHaplotypes and loadHaplotypes), merging neutral and positive simulations (mergeData), and building and training CNN (buildCNN, trainTestData and trainCNN, or streamed from a training store with splitStore and storeDataset) '''
+
+def sortHaplotypes(haplotypes, sort_row = False, sort_col = False):
+    '''Sorts the rows (haplotypes) and then the columns (sites) of an image, or of every image of a (batch, rows, cols) stack at once, by decreasing mutation count. Ties keep their original order'''
+    import numpy as np
+    haplotypes = np.asarray(haplotypes)
+    if sort_row == True:
+        order = np.argsort(-haplotypes.sum(axis=-1, dtype=np.int64), axis=-1, kind='stable')
+        rows, cols = haplotypes.shape[-2:]
+        offsets = np.arange(order.size // rows)[:,None] * rows # Whole rows are copied from the flattened stack, much faster than an element-wise gather
+        haplotypes = haplotypes.reshape((-1, cols))[(order.reshape((-1, rows)) + offsets).ravel()].reshape(haplotypes.shape)
+    if sort_col == True:
+        order = np.argsort(-haplotypes.sum(axis=-2, dtype=np.int64), axis=-1, kind='stable')
+        haplotypes = np.take_along_axis(haplotypes, order[...,None,:], axis=-1)
+    return haplotypes
 
 def sampleData(sims, size, reps, sort_row = False, sort_col = False):
-    '''Generates a haplotype array (predictor) and evolutionary mode and fitness (responses)'''
+    '''Generates a haplotype array (predictor) and evolutionary mode and fitness (responses). All reps are sampled, compared to the reference and sorted at once; haplotypes are uint8'''
     import numpy as np
-    import tensorflow as tf
-    store_mode = []
-    store_haplotypes = []
     fitness = sims.w
     mode = str(fitness) if fitness > 1 else 'neutral'
+    indices = np.array([np.random.choice(sims.mutations.shape[0], size = size, replace = False) for i in range(reps)]).reshape((reps, size))
+    reference = np.asarray(sims.reference)
+    haplotypes = (sims.sample(indices.ravel()) != reference).astype(np.uint8).reshape((reps, size, len(reference)))
+    haplotypes = sortHaplotypes(haplotypes, sort_row, sort_col)
+    return (haplotypes, np.array([mode] * reps))
+
+def sampleWindows(sims, size, reps, window, step = None, sort_row = False, sort_col = False):
+    '''Cuts many training images from one (full-genome) simulation: reps row subsamples, each split into windows of window bp every step bp (non-overlapping by default).
+    A window is labelled with the simulation fitness if a beneficial locus in it is mutated in the subsample, otherwise neutral. Returns (haplotypes, modes, window starts)'''
+    import numpy as np
+    step = window if step is None else step
+    starts = np.arange(0, sims.mutations.shape[1] - window + 1, step)
+    reference = np.asarray(sims.reference)
+    positive = np.zeros(len(reference), dtype = bool)
+    positive[sims.positiveLoci] = True
+    haplotypes = np.empty((reps * len(starts), size, window), dtype = np.uint8)
+    store_mode = []
+    store_starts = []
     for i in range(reps):
-        haplotypes = sims.mutations
-        indices = np.random.choice(haplotypes.shape[0], size = size, replace = False)
-        samples = haplotypes[indices,:]
-        haplotypes = [[0 if samples[i,j] == sims.reference[j] else samples[i,j] for j in range(samples.shape[1])] for i in range(samples.shape[0])]
-        haplotypes = (np.array(haplotypes) > 0).astype(int).tolist()
-        if sort_row == True:
-            haplotypes = np.array(haplotypes)
-            haplotypes = haplotypes[np.argsort(haplotypes.sum(axis=1))[::-1],:].tolist()
-        if sort_col == True:
-            haplotypes = np.array(haplotypes)
-            haplotypes = haplotypes[:,np.argsort(haplotypes.sum(axis=0))[::-1]].tolist()
-        store_mode.append(mode)
-        store_haplotypes.append(haplotypes)
-    return (np.array(store_haplotypes), np.array(store_mode))
+        indices = np.random.choice(sims.mutations.shape[0], size = size, replace = False)
+        samples = (sims.sample(indices) != reference).astype(np.uint8)
+        selected = positive & (samples.sum(axis = 0) > 0)
+        for k, start in enumerate(starts): # One window at a time, so overlapping windows are never materialized together with an intermediate copy
+            haplotypes[i * len(starts) + k] = sortHaplotypes(samples[:, start:start + window], sort_row, sort_col)
+            store_mode.append(str(sims.w) if sims.w > 1 and selected[start:start + window].any() else 'neutral')
+            store_starts.append(start)
+    return (haplotypes, np.array(store_mode), np.array(store_starts))
 
-def mergeData(positive_dir, neutral_dir, n = 100, remove = 'NAN'):
-    '''Merges positive and neutral simulations into one array for CNN training'''
+def saveHaplotypes(file, haplotypes, **params):
+    '''Saves binary haplotype images bit-packed along the last axis (one bit per site) as npz, with their shape and the simulation parameters as metadata'''
+    import numpy as np
+    import json
+    haplotypes = np.asarray(haplotypes)
+    np.savez(file, bits = np.packbits(haplotypes.astype(bool), axis = -1), shape = np.array(haplotypes.shape), params = json.dumps(params))
+
+def loadHaplotypes(file, params = False):
+    '''Loads haplotype images saved by saveHaplotypes as uint8 (legacy .npy images are loaded as they are). With params = True also returns the simulation parameters'''
+    import numpy as np
+    import json
+    if str(file).endswith('.npy'):
+        haplotypes = np.load(file)
+        return (haplotypes, {}) if params else haplotypes
+    with np.load(file, allow_pickle = False) as f:
+        shape = tuple(f['shape'])
+        haplotypes = np.unpackbits(f['bits'], axis = -1, count = shape[-1]).reshape(shape)
+        metadata = json.loads(str(f['params']))
+    return (haplotypes, metadata) if params else haplotypes
+
+def mergeData(positive_dir, neutral_dir, n = 100, remove = 'NAN', store = None):
+    '''Merges positive and neutral simulations into one array for CNN training. With store (a directory written by store.packStore) the images are read from its memory-mapped shards instead of the two directories'''
     import numpy as np
     import random
     import os
+    if store is not None:
+        from store import HaplotypeStore
+        store = HaplotypeStore(store)
+        pos_simulations, neu_simulations = store.sample('positive', n), store.sample('neutral', n)
+        haplotypes = store.images(np.concatenate((neu_simulations, pos_simulations)))
+        modes = ['neutral' for i in range(len(neu_simulations))] + ['positive' for i in range(len(pos_simulations))]
+        return (haplotypes, modes)
     pos_simulations = random.sample(os.listdir(positive_dir), k=n)
     neu_simulations = random.sample(os.listdir(neutral_dir), k=n)
-    positive_haplotypes = np.vstack(np.array([np.load(positive_dir + i) for i in pos_simulations]))
-    neutral_haplotypes = np.vstack(np.array([np.load(neutral_dir + i) for i in neu_simulations]))
+    positive_haplotypes = np.vstack([loadHaplotypes(positive_dir + i) for i in pos_simulations])
+    neutral_haplotypes = np.vstack([loadHaplotypes(neutral_dir + i) for i in neu_simulations])
     haplotypes = np.vstack((neutral_haplotypes, positive_haplotypes))
     modes = ['neutral' for i in range(len(neutral_haplotypes))] + ['positive' for i in range(len(positive_haplotypes))]
     return (haplotypes, modes)
 
 def trainTestData(haplotypes, modes, p, sort_row = True, sort_col = True):
     '''Splits data into training and test set for CNN training'''
-    import numpy as np
     import tensorflow as tf
     from sklearn.model_selection import train_test_split
     tf.random.set_seed(123456)
-    if sort_row == True:
-        haplotypes = np.array(haplotypes)
-        haplotypes = np.array([i[np.argsort(i.sum(axis=1))[::-1],:].tolist() for i in haplotypes])
-    if sort_col == True:
-        haplotypes = np.array(haplotypes)
-        haplotypes = np.array([i[:,np.argsort(i.sum(axis=0))[::-1]].tolist() for i in haplotypes])
+    haplotypes = sortHaplotypes(haplotypes, sort_row, sort_col)
     train_x, test_x, train_y, test_y = train_test_split(haplotypes, modes, stratify = modes, test_size = p, shuffle = True)
     train_dataset, test_dataset = (train_x, train_y), (test_x, test_y)
     return (train_dataset, test_dataset)
 
-def trainCNN(train, test, nrows = 200, ncols = 2500, size_batch = 32):
-    '''Train CNN on aligned haplotypes. Setup to train on nrows (haplotypes) X ncols (base pair) alignments'''
-    import tensorflow as tf
-    from tensorflow.keras import datasets, layers, models, regularizers
+def splitStore(store, p, n = None, seed = 123456):
+    '''Stratified train/test split of the record indices of a training store (n records per class if given, otherwise all of them)'''
     import numpy as np
-    tf.random.set_seed(123456)
-    # Load data
-    train_x, train_y = train
-    test_x, test_y = test
-    # Some more preprocessing
-    train_x = train_x.reshape(train_x.shape + (1,))
-    test_x = test_x.reshape(test_x.shape + (1,))
-    train_y = np.array([1 if i == 'positive' else 0 for i in train_y])
-    test_y = np.array([1 if i == 'positive' else 0 for i in test_y])
-    # Early stopping
-    callback = tf.keras.callbacks.EarlyStopping(monitor='loss', patience=3)
-    # Initialize model
+    from store import HaplotypeStore
+    store = HaplotypeStore(store) if isinstance(store, str) else store
+    rng = np.random.default_rng(seed)
+    train, test = [], []
+    for label in ['neutral', 'positive']:
+        indices = store.sample(label, n, rng) if n is not None else rng.permutation(np.nonzero((store.labels['label'] == label).values)[0])
+        k = int(round(p * len(indices)))
+        test.append(indices[:k])
+        train.append(indices[k:])
+    return (rng.permutation(np.concatenate(train)), np.concatenate(test))
+
+def storeDataset(store, indices, sort_row = False, sort_col = False, shuffle = False, buffer_size = 4096, size_batch = 32, seed = 123456):
+    '''Streams the records in indices of a training store as a tf.data.Dataset of (images, labels) batches. Only indices and labels are held in memory: records are
+    shuffled within a bounded buffer, read from the memory-mapped shards and decoded (unpacked and sorted) batch by batch in parallel, and prefetched'''
+    import numpy as np
+    import tensorflow as tf
+    from store import HaplotypeStore
+    store = HaplotypeStore(store) if isinstance(store, str) else store
+    indices = np.asarray(indices, dtype = np.int64)
+    labels = (store.labels['label'].values[indices] == 'positive').astype(np.int64)
+    def decode(batch):
+        haplotypes = sortHaplotypes(store.images(batch), sort_row, sort_col)
+        return haplotypes.astype(np.float32)[..., None]
+    def load(batch, y):
+        x = tf.numpy_function(decode, [batch], tf.float32)
+        return (tf.ensure_shape(x, (None,) + store.shape + (1,)), y)
+    dataset = tf.data.Dataset.from_tensor_slices((indices, labels))
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size, seed = seed, reshuffle_each_iteration = True)
+    dataset = dataset.batch(size_batch).map(load, num_parallel_calls = tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+def buildCNN(nrows = 200, ncols = 2500):
+    '''CNN architecture for nrows (haplotypes) X ncols (base pair) alignments: a conv/pool trunk with valid padding followed by a dense head'''
+    from tensorflow.keras import layers, models, regularizers
     model = models.Sequential()
     model.add(layers.Conv2D(32, (3, 3), activation='relu', input_shape=(nrows, ncols, 1), kernel_regularizer=regularizers.l1_l2(l1=0.008, l2=0.008)))
     model.add(layers.MaxPooling2D((2, 2)))
@@ -80,15 +145,39 @@ def trainCNN(train, test, nrows = 200, ncols = 2500, size_batch = 32):
     model.add(layers.Flatten())
     model.add(layers.Dense(64, activation='relu'))
     model.add(layers.Dense(1, activation='sigmoid'))
+    return model
+
+def trainCNN(train, test, nrows = 200, ncols = 2500, size_batch = 32):
+    '''Train CNN on aligned haplotypes. Setup to train on nrows (haplotypes) X ncols (base pair) alignments. train and test are either (haplotypes, modes) arrays or batched datasets from storeDataset'''
+    import tensorflow as tf
+    from tensorflow.keras import datasets, layers, models, regularizers
+    import numpy as np
+    tf.random.set_seed(123456)
+    streaming = isinstance(train, tf.data.Dataset)
+    if not streaming:
+        # Load data
+        train_x, train_y = train
+        test_x, test_y = test
+        # Some more preprocessing
+        train_x = train_x.reshape(train_x.shape + (1,))
+        test_x = test_x.reshape(test_x.shape + (1,))
+        train_y = np.array([1 if i == 'positive' else 0 for i in train_y])
+        test_y = np.array([1 if i == 'positive' else 0 for i in test_y])
+    # Early stopping
+    callback = tf.keras.callbacks.EarlyStopping(monitor='loss', patience=3)
+    # Initialize model
+    model = buildCNN(nrows, ncols)
     METRICS = [tf.keras.metrics.BinaryAccuracy(name='accuracy'),tf.keras.metrics.Precision(name='precision'),tf.keras.metrics.Recall(name='recall'),tf.keras.metrics.AUC(name='auc')]
     model.compile(optimizer='rmsprop', loss='binary_crossentropy', metrics=METRICS)
-    if size_batch > 0:
+    if streaming:
+        history = model.fit(train, epochs=30, validation_data=test, callbacks = [callback])
+    elif size_batch > 0:
         history = model.fit(train_x, train_y, batch_size = size_batch, epochs=30, validation_data=(test_x, test_y), callbacks = [callback])
     else:
         history = model.fit(train_x, train_y, epochs=25, validation_data=(test_x, test_y), callbacks = [callback])
     return (model, history)
 
-def trainLSTMreg(features, fitness, multi = False, nepochs = 30, regularization):
+def trainLSTMreg(features, fitness, multi = False, nepochs = 30, regularization = 0.0):
     import tensorflow as tf
     import pandas as pd
     import numpy as np
@@ -110,7 +199,7 @@ def trainLSTMreg(features, fitness, multi = False, nepochs = 30, regularization)
     model.fit(train_x, train_y, epochs=nepochs, batch_size = 32, validation_data=(test_x, test_y), callbacks = callback)
     return (model)
 
-def trainLSTM(features, fitness, multi = False, nepochs = 30, regularization):
+def trainLSTM(features, fitness, multi = False, nepochs = 30, regularization = 0.0):
     import tensorflow as tf
     import pandas as pd
     import numpy as np
@@ -134,36 +223,3 @@ def trainLSTM(features, fitness, multi = False, nepochs = 30, regularization):
     callback = tf.keras.callbacks.EarlyStopping(monitor='loss', patience=4)
     model.fit(train_x, train_y, epochs=nepochs, batch_size = 32, validation_data=(test_x, test_y), callbacks = callback)
     return (model)
-
-def popgenStats(haplotypes, n = 200):
-    counts = np.array([i for i in np.sum(haplotypes, axis = 0) if i < 200 and i > 0])
-    # Watterson's estimator
-    S = len(counts)
-    an = np.sum([1/i for i in range(1, n)])
-    theta_w = S / an
-    # Tajima's pi
-    vafs = counts / n
-    d = np.sum(vafs * (1 - vafs)) * (n^2)
-    theta_pi = d / len([j for j in combinations([i for i in range(n)], 2)])
-    # Variance for Tajima's D
-    a1 = np.sum([1/i for i in range(1, n)])
-    a2 = np.sum([1/(i*i) for i in range(1, n)])
-    b1 = (n + 1) / (3 * (n - 1))
-    b2 = (2 * ((n*n) + n + 3)) / (9 * n * (n - 1))
-    c1 = b1 - (1 / a1)
-    c2 = b2 - ((n + 2) / (a1 * n)) + (a2 / (a1*a1))
-    e1 = c1 / a1
-    e2 = c2 / ((a1*a1) + a2)
-    seD = np.sqrt((e1 *S) + ((e2 * S) * (S - 1)))
-    TajimasD = (theta_pi - theta_w) / seD
-    # Fay and Wu's H
-    theta_l = np.sum(vafs) * (n / (n - 1))
-    bn = np.sum([1/(i*i) for i in range(1, n)])
-    bn1 = np.sum([1/(i*i) for i in range(1, n+1)])
-    theta2 = (S * (S - 1)) / ((an*an) + bn)
-    seH = np.sqrt((((n - 2) / (6*(n - 1))) * theta_w) + (theta2 * (((18 * (n*n) * (3 * n + 2) * bn1) - (88 * (n*n*n) + 9 * (n*n) - 13*n + 6))/(9 * n * ((n - 1)*(n-1))))))
-    WuH = 2 * ((theta_pi - theta_l) / seH)
-    if np.isnan([TajimasD]) == True and np.isnan([WuH]) == True:
-        return [-3, 0]
-    else:
-        return [TajimasD, WuH]
\ No newline at end of file
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+''' Description: Batched CNN scan over sliding windows. Window images of every subsample are built lazily (optionally ahead of time by worker threads), sorted and streamed to the
+model in fixed-size batches through one compiled inference function, and the scores are scattered back to their (subsample, window) coordinates. Alternatively (scanConvolutional) the conv/pool
+trunk of the CNN runs once over the whole genome and only the dense head is evaluated per window '''
+
+import time
+
+def windowWidth(windows):
+    '''Common width of the windows [index1, index2) in windows'''
+    import numpy as np
+    windows = np.asarray(windows)
+    width = windows[0,1] - windows[0,0]
+    if np.any(windows[:,1] - windows[:,0] != width):
+        raise ValueError('All windows must have the same width')
+    return int(width)
+
+def windowImages(haplotypes, windows, coordinates, sort_row = False, sort_col = False, out = None):
+    '''Sorted images of the (subsample, window) pairs in coordinates, as uint8 (len(coordinates), rows, width) or written into the first len(coordinates) images of out'''
+    import numpy as np
+    from model import sortHaplotypes
+    windows = np.asarray(windows)
+    width = windowWidth(windows)
+    images = sortHaplotypes(np.stack([haplotypes[i, :, start:start + width] for (i, start) in zip(coordinates[:,0], windows[coordinates[:,1], 0])]), sort_row, sort_col)
+    if out is None:
+        return images
+    out[:len(coordinates)] = images
+    return out
+
+def windowCoordinates(subsamples, windows):
+    '''(subsample, window) pairs of every window of every subsample, subsample by subsample'''
+    import numpy as np
+    return np.stack(np.meshgrid(np.arange(subsamples), np.arange(len(windows)), indexing = 'ij'), axis = -1).reshape((-1, 2))
+
+def prefetch(items, prepare, workers = 2, depth = 2, timing = None):
+    '''Yields prepare(item) for each item of items in order. depth results are kept in preparation by workers threads while the caller consumes the
+    previous one; the time spent waiting for a result is added to timing['stall']'''
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    from itertools import islice
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        pending = deque(pool.submit(prepare, item) for item in islice(items, depth))
+        while pending:
+            start_time = time.time()
+            result = pending.popleft().result()
+            if timing is not None:
+                timing['stall'] += time.time() - start_time
+            pending.extend(pool.submit(prepare, item) for item in islice(items, 1)) # Refill before yielding, so depth items are prepared while the caller uses this one
+            yield result
+
+def windowBatches(haplotypes, windows, sort_row = False, sort_col = False, batch_size = 256, workers = 0, depth = 2, timing = None):
+    '''Yields (coordinates, images) for consecutive batches of the (subsample, window) pairs of haplotypes (subsamples, rows, sites). Every batch holds batch_size
+    float32 images of shape (rows, width, 1); the last one is padded with empty images, and coordinates only lists the real ones. With workers > 0 the batches
+    are built ahead by worker threads (prefetch), at most depth of them at a time'''
+    import numpy as np
+    width = windowWidth(windows)
+    coordinates = windowCoordinates(haplotypes.shape[0], windows)
+
+    def build(k):
+        batch = coordinates[k:k + batch_size]
+        images = np.zeros((batch_size, haplotypes.shape[1], width), dtype = np.float32)
+        windowImages(haplotypes, windows, batch, sort_row, sort_col, out = images)
+        return (batch, images[..., None])
+
+    if workers > 0:
+        yield from prefetch(range(0, len(coordinates), batch_size), build, workers, depth, timing)
+        return
+    for k in range(0, len(coordinates), batch_size):
+        start_time = time.time()
+        batch = build(k)
+        if timing is not None:
+            timing['stall'] += time.time() - start_time
+        yield batch
+
+def compileScorer(model, rows, width, batch_size = 256):
+    '''Inference function of model compiled once for float32 batches of batch_size images of shape (rows, width, 1)'''
+    import tensorflow as tf
+    return tf.function(lambda x: model(x, training = False), input_signature = [tf.TensorSpec((batch_size, rows, width, 1), tf.float32)])
+
+def scanWindows(model, haplotypes, windows, sort_row = False, sort_col = False, batch_size = 256, workers = 0, depth = 2, verbose = True):
+    '''Scores of model for every window [index1, index2) in windows of every subsample in haplotypes (subsamples, rows, sites). Returns a (subsamples, windows)
+    array. The model is compiled once for fixed-size batches, so there is a single trace whatever the number of windows. With workers > 0, window images are
+    sliced and sorted by worker threads while the model scores the previous batches; the report splits the time into stall (waiting for images) and compute'''
+    import numpy as np
+    infer = compileScorer(model, haplotypes.shape[1], windowWidth(windows), batch_size)
+    scores = np.full((haplotypes.shape[0], len(windows)), np.nan)
+    timing = {'stall': 0.0, 'compute': 0.0}
+    start_time = time.time()
+    for batch, images in windowBatches(haplotypes, windows, sort_row, sort_col, batch_size, workers, depth, timing):
+        compute_time = time.time()
+        scores[batch[:,0], batch[:,1]] = infer(images).numpy()[:len(batch)].reshape((len(batch), -1))[:,0]
+        timing['compute'] += time.time() - compute_time
+    if verbose:
+        elapsed = time.time() - start_time
+        print('Scanned ' + str(scores.size) + ' windows in ' + str(round(elapsed, 2)) + ' seconds (' + str(round(scores.size / max(elapsed, 1e-9), 1)) + ' windows/sec; '
+            + str(round(timing['stall'], 2)) + ' s stalled on images, ' + str(round(timing['compute'], 2)) + ' s in the CNN)')
+    return scores
+
+def fullyConvolutional(model):
+    '''Splits a CNN from model.buildCNN into its conv/pool trunk, rebuilt to take images of any width, and its dense head. Returns (trunk, head layers, column
+    stride of the trunk). Needs valid padding: with same padding the columns at a window edge see the neighbouring columns of the genome'''
+    import tensorflow as tf
+    layers = model.layers
+    flatten = [k for (k, layer) in enumerate(layers) if isinstance(layer, tf.keras.layers.Flatten)][0]
+    x = inputs = tf.keras.Input(shape = (model.input_shape[1], None, model.input_shape[3]))
+    stride = 1
+    for layer in layers[:flatten]:
+        config = layer.get_config()
+        if config.get('padding', 'valid') != 'valid':
+            raise ValueError(layer.name + ' uses ' + config['padding'] + ' padding; only valid padding can be scanned convolutionally')
+        stride *= config.get('strides', (1, 1))[1]
+        config.pop('batch_input_shape', None)
+        clone = layer.__class__.from_config(config)
+        x = clone(x)
+        clone.set_weights(layer.get_weights())
+    return (tf.keras.Model(inputs, x), layers[flatten + 1:], stride)
+
+def scanConvolutional(model, haplotypes, windows, sort_row = False, chunk = 32, verbose = True):
+    '''Scores of model for every window [index1, index2) of every subsample in haplotypes (subsamples, rows, sites), running the trunk once per subsample and
+    pooling phase. A window starting at column s reads the trunk output of the genome shifted by s % stride at column s // stride, so the results equal per-window
+    scoring (see agreement) for the same images. Rows can only be sorted once over the whole genome (sort_row = True), not per window; columns cannot be sorted'''
+    import numpy as np
+    import tensorflow as tf
+    from model import sortHaplotypes
+    trunk, head, stride = fullyConvolutional(model)
+    windows = np.asarray(windows)
+    width = windowWidth(windows)
+    features = trunk.compute_output_shape((None, haplotypes.shape[1], width, 1))[2]
+    phases = windows[:,0] % stride
+    scores = np.full((haplotypes.shape[0], len(windows)), np.nan)
+    start_time = time.time()
+    for j in range(haplotypes.shape[0]):
+        image = sortHaplotypes(haplotypes[j], sort_row = sort_row).astype(np.float32)
+        for phase in np.unique(phases):
+            selected = np.nonzero(phases == phase)[0]
+            trunk_output = trunk(image[None,:,phase:,None], training = False)[0]
+            positions = (windows[selected,0] - phase) // stride
+            for k in range(0, len(selected), chunk):
+                columns = positions[k:k + chunk,None] + np.arange(features)
+                x = tf.transpose(tf.gather(trunk_output, columns, axis = 1), (1, 0, 2, 3))
+                x = tf.reshape(x, (len(columns), -1))
+                for layer in head:
+                    x = layer(x, training = False)
+                scores[j, selected[k:k + chunk]] = np.asarray(x)[:,0]
+    if verbose:
+        elapsed = time.time() - start_time
+        print('Scanned ' + str(scores.size) + ' windows convolutionally in ' + str(round(elapsed, 2)) + ' seconds (' + str(round(scores.size / max(elapsed, 1e-9), 1)) + ' windows/sec)')
+    return scores
+
+def agreement(model, haplotypes, windows, sort_row = False, batch_size = 256):
+    '''Largest absolute difference between scanConvolutional and per-window scoring (scanWindows) of the same images. Rows are sorted over the whole genome
+    for both when sort_row is True'''
+    import numpy as np
+    from model import sortHaplotypes
+    haplotypes = sortHaplotypes(haplotypes, sort_row = sort_row)
+    convolutional = scanConvolutional(model, haplotypes, windows, verbose = False)
+    windowed = scanWindows(model, haplotypes, windows, batch_size = batch_size, verbose = False)
+    return float(np.max(np.abs(convolutional - windowed)))
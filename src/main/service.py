@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+''' Description: Local inference service for empirical scans. Loads the CNN, the classification RNN and the regression ensemble once and answers slide.py requests
+over localhost HTTP or a Unix socket. Windows of concurrent requests are queued and scored together in fixed-size CNN batches (WindowBatcher) '''
+
+import argparse
+import json
+import os
+import queue
+import random
+import socketserver
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Job:
+    '''Windows of one request waiting for their CNN scores'''
+    def __init__(self, haplotypes, windows):
+        import numpy as np
+        self.haplotypes = haplotypes
+        self.windows = np.asarray(windows)
+        self.scores = np.full((haplotypes.shape[0], len(windows)), np.nan)
+        self.remaining = self.scores.size
+        self.error = None
+        self.done = threading.Event()
+
+    def update(self, coordinates, scores = None, error = None):
+        if error is not None:
+            self.error = error
+            self.done.set()
+            return
+        self.scores[coordinates[:,0], coordinates[:,1]] = scores
+        self.remaining -= len(coordinates)
+        if self.remaining == 0:
+            self.done.set()
+
+class WindowBatcher:
+    '''Scores (subsample, window) pairs of concurrent requests with one compiled CNN. Requests are split into chunks of coordinates on a shared queue; a worker
+    thread fills each batch of batch_size images from as many chunks as fit, waiting at most max_wait seconds for more once a batch is started'''
+    def __init__(self, model, rows, width, sort_row = True, batch_size = 256, max_wait = 0.01):
+        from scan import compileScorer
+        self.infer = compileScorer(model, rows, width, batch_size)
+        self.rows, self.width = rows, width
+        self.sort_row = sort_row
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.batches, self.windows = 0, 0
+        threading.Thread(target = self.run, daemon = True).start()
+
+    def score(self, haplotypes, windows):
+        '''Scores of every window of every subsample in haplotypes (subsamples, rows, sites), as scanWindows. Blocks until all of them are scored'''
+        from scan import windowWidth, windowCoordinates
+        if haplotypes.shape[1] != self.rows or windowWidth(windows) != self.width:
+            raise ValueError('The CNN takes ' + str(self.rows) + ' x ' + str(self.width) + ' images')
+        job = Job(haplotypes, windows)
+        coordinates = windowCoordinates(haplotypes.shape[0], windows)
+        for k in range(0, len(coordinates), self.batch_size):
+            self.queue.put((job, coordinates[k:k + self.batch_size]))
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.scores
+
+    def collect(self, carry):
+        '''Chunks of the next batch, and the part of a chunk that did not fit'''
+        batch = [carry if carry is not None else self.queue.get()]
+        filled = len(batch[0][1])
+        deadline = time.time() + self.max_wait
+        while filled < self.batch_size:
+            try:
+                job, coordinates = self.queue.get(timeout = max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            space = self.batch_size - filled
+            if len(coordinates) > space:
+                batch.append((job, coordinates[:space]))
+                return (batch, (job, coordinates[space:]))
+            batch.append((job, coordinates))
+            filled += len(coordinates)
+        return (batch, None)
+
+    def run(self):
+        import numpy as np
+        from scan import windowImages
+        carry = None
+        while True:
+            batch, carry = self.collect(carry)
+            batch = [(job, coordinates) for (job, coordinates) in batch if job.error is None] # Remaining chunks of failed requests are dropped
+            if len(batch) == 0:
+                continue
+            try:
+                images = np.zeros((self.batch_size, self.rows, self.width), dtype = np.float32)
+                k = 0
+                for job, coordinates in batch:
+                    windowImages(job.haplotypes, job.windows, coordinates, self.sort_row, out = images[k:k + len(coordinates)])
+                    k += len(coordinates)
+                scores = self.infer(images[..., None]).numpy()[:k].reshape((k, -1))[:,0]
+            except Exception as e: # Fail the requests of this batch; the worker keeps serving the others
+                for job, coordinates in batch + ([carry] if carry is not None else []):
+                    job.update(coordinates, error = e)
+                carry = None
+                continue
+            k = 0
+            for job, coordinates in batch:
+                job.update(coordinates, scores[k:k + len(coordinates)])
+                k += len(coordinates)
+            self.batches += 1
+            self.windows += k
+
+class ScanService:
+    '''Models and window layout of slide.py, kept in memory between requests'''
+    def __init__(self, directory, cnn, classification, regression, fused = None, legacy = False, batch_size = 256, max_wait = 0.01, cache_size = 10000):
+        import tensorflow as tf
+        from ensemble import EnsemblePredictor
+        from empirical import slidingSteps, decodeHaplotype
+        self.directory = directory
+        self.legacy = legacy
+        self.cnn = tf.keras.models.load_model(cnn)
+        self.steps = slidingSteps(alignment_size = int(self.cnn.input_shape[2])) # Windows as wide as the CNN input
+        self.classification = tf.keras.models.load_model(classification)
+        self.ensemble = EnsemblePredictor(regression, fused = fused)
+        self.batcher = WindowBatcher(self.cnn, self.cnn.input_shape[1], self.cnn.input_shape[2], sort_row = True, batch_size = batch_size, max_wait = max_wait)
+        self.lock = threading.Lock() # Keras predict on the RNNs is not shared between threads
+        self.requests = 0
+
+        @lru_cache(maxsize = cache_size)
+        def read(path):
+            with open(path, 'rb') as f:
+                return decodeHaplotype(f.read())
+        self.read = read
+
+    def scan(self, request):
+        '''Per-subsample table of slide.py for a request: either target (a CSV with a filename column) or filenames, read from directory (the service directory
+        by default), or haplotypes (a list of 0/1 strings or rows). Optional: subsamples (25), seed, and output (directory where the CSV is also written)'''
+        import numpy as np
+        import pandas as pd
+        from empirical import loadGenomes, drawSubsamples, predictSubsamples, decodeHaplotype
+        start_time = time.time()
+        if 'haplotypes' in request:
+            matrix = np.array([decodeHaplotype(i) if isinstance(i, str) else np.asarray(i, dtype = np.uint8) for i in request['haplotypes']])
+            filenames = list(range(len(matrix)))
+            rows = {i: i for i in filenames}
+        else:
+            filenames = list(pd.read_csv(request['target'])['filename']) if 'target' in request else list(request['filenames'])
+            matrix, rows = loadGenomes(filenames, request.get('directory', self.directory), read = self.read)
+        if matrix.ndim != 2 or matrix.shape[1] < self.steps[-1][1]:
+            raise ValueError('Haplotypes must have at least ' + str(self.steps[-1][1]) + ' sites')
+        rng = random.Random(request.get('seed'))
+        subsamples, tajD, wuH = drawSubsamples(matrix, rows, filenames, self.steps, int(request.get('subsamples', 25)), legacy = self.legacy, rng = rng, verbose = False)
+        scores = self.batcher.score(subsamples, self.steps)
+        with self.lock:
+            output = predictSubsamples(self.classification, self.ensemble, scores, tajD, wuH)
+        if 'output' in request:
+            name = request['target'].split('/')[-1].split('.csv')[0] if 'target' in request else str(request.get('name', 'request'))
+            output.to_csv(os.path.join(request['output'], 'empirical_predictions_' + name + '.csv'), index = False)
+        self.requests += 1
+        print('Scanned ' + str(len(filenames)) + ' haplotypes in ' + str(round(time.time() - start_time, 2)) + ' seconds')
+        return output
+
+class Handler(BaseHTTPRequestHandler):
+    '''GET /health, POST /scan (JSON request of ScanService.scan; the response holds the table as lists per column)'''
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self.reply(404, {'error': 'Unknown path ' + self.path})
+        batcher = self.server.service.batcher
+        self.reply(200, {'status': 'ok', 'requests': self.server.service.requests, 'batches': batcher.batches, 'windows': batcher.windows})
+
+    def do_POST(self):
+        if self.path != '/scan':
+            return self.reply(404, {'error': 'Unknown path ' + self.path})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            output = self.server.service.scan(request)
+        except (ValueError, KeyError, OSError) as e:
+            return self.reply(400, {'error': type(e).__name__ + ': ' + str(e)})
+        except Exception as e: # Model errors re-raised from the batcher or the RNNs
+            return self.reply(500, {'error': type(e).__name__ + ': ' + str(e)})
+        self.reply(200, output.to_dict(orient = 'list'))
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve(service, host = '127.0.0.1', port = 8765, socket = None):
+    '''Serves service on host:port, or on the Unix socket path socket, until interrupted'''
+    if socket is not None:
+        if os.path.exists(socket):
+            os.remove(socket)
+        server = UnixHTTPServer(socket, Handler)
+    else:
+        server = ThreadingHTTPServer((host, port), Handler)
+    server.service = service
+    print('Serving on ' + (socket if socket is not None else host + ':' + str(port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket is not None and os.path.exists(socket):
+            os.remove(socket)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Local service scanning empirical haplotypes with resident models')
+    parser.add_argument('-d', '--haplotype_directory', default = '', help='Directory containing the binary encoded haplotypes (default of the requests).')
+    parser.add_argument('-cnn', '--cnn_model', help='CNN model, e.g. newest_2500_5e-6_row_2020-12-28-07-07_cnn.tf')
+    parser.add_argument('-rnn', '--rnn_classification', help='Classification RNN, e.g. classification_0.0_wuH_CNN_rnn.tf')
+    parser.add_argument('-ens', '--rnn_regression', help='Directory containing the regression LSTMs and rnn_ensemble.joblib')
+    parser.add_argument('-fr', '--fused_rnn', default = None, help='Fused regression ensemble exported by ensemble.py, used instead of loading the ten LSTMs.')
+    parser.add_argument('-ls', '--legacy_stats', action = 'store_true', help='Compute Tajima\'s D and Fay and Wu\'s H as earlier versions did (pi scaled by n^2 as XOR).')
+    parser.add_argument('-host', '--host', default = '127.0.0.1', help='Address to listen on.')
+    parser.add_argument('-p', '--port', default = 8765, type = int, help='Port to listen on.')
+    parser.add_argument('-u', '--socket', default = None, help='Unix socket to listen on instead of host:port.')
+    parser.add_argument('-bs', '--batch_size', default = 256, type = int, help='Number of windows per CNN batch.')
+    parser.add_argument('-mw', '--max_wait', default = 10, type = float, help='Time (ms) a started batch waits for windows of other requests.')
+    parser.add_argument('-hc', '--haplotype_cache', default = 10000, type = int, help='Number of decoded haplotype files kept in memory (about 30 kB each, i.e. 300 MB by default).')
+    # Example argument
+    # - python3 service.py -d haplotypes/ -cnn cnn.tf -rnn classification_0.0_wuH_CNN_rnn.tf -ens models/ -u /tmp/imhape.sock
+    # - curl --unix-socket /tmp/imhape.sock -d '{"target": "targets/region.csv", "output": "results/"}' http://localhost/scan
+    args = parser.parse_args()
+    service = ScanService(args.haplotype_directory, args.cnn_model, args.rnn_classification, args.rnn_regression, fused = args.fused_rnn, legacy = args.legacy_stats,
+        batch_size = args.batch_size, max_wait = args.max_wait / 1000, cache_size = args.haplotype_cache)
+    serve(service, args.host, args.port, args.socket)
@@ -1,12 +1,61 @@
 #!/usr/bin/env python3
 ''' Description: This script contains the viral evolution simulation script and is the basis for evolutionary inferences. It works as a random birth-death process which is parametrized by birth/death rates, fitness, mutation rates, and probability of beneficial mutations '''
 
-def simulateViralEvolution(genomeSize, initSize, gens, mutRate, probBen, r, w, x, maxPopSize = 1e7, maxBenSize = 1e7, print_per_gen = 1):
+def _printParameters(genomeSize, gens, mutRate, probBen, r, x, w):
+    print("¬¬¬¬¬¬¬¬¬¬¬¬¬¬¬¬")
+    print("Viral simulation")
+    print("¬¬¬¬¬¬¬¬¬¬¬¬¬¬¬¬")
+    print('')
+    print('1/3 Simulation parameters')
+    print('-------------------------')
+    print(f'Genome size (bp): {genomeSize}')
+    print(f'Generations (divisions): {gens}')
+    print(f'Mutation rate (µ): {mutRate}')
+    print(f'Probability of a beneficial mutation: {probBen}')
+    print(f'Viral replication rate (r): {r}')
+    print(f'Viral death rate (x): {x}')
+    print(f'Fitness (1 + s): {w}')
+    print('')
+    print('Replication coefficient neutral viruses : %s' %(r - x))
+    print('Replication coefficient beneficial viruses: %s' %(r - x/w))
+    print('')
+
+def _printGeneration(j, print_per_gen, numberNeutral, numberBeneficial, rN, rB):
+    if j == 0:
+        print('2/3 Growth and rates per generation')
+        print('-----------------------------------')
+        print('{:6s} {:6s} {:6s} {:6s} {:6s}'.format('Gen', 'NP', 'BP', 'rN', 'rB'))
+    else:
+        if j % print_per_gen == 0:
+            print('{:2d} {:6d} {:5d} {:7.2f} {:6.2f}'.format(j, int(numberNeutral), int(numberBeneficial), rN, rB))
+
+def _printSummary(output, start_time):
+    import time
+    print('')
+    print('3/3 Population description')
+    print('--------------------------')
+    print(f'Number of beneficial viruses: {output.numberBeneficial}')
+    print(f'Number of neutral viruses: {output.numberNeutral}')
+    elapsed_time = time.time() - start_time
+    print('Time elapsed is ',elapsed_time, 'seconds')
+
+def _virusFrequencies(viruses, reference):
+    '''Population frequency of every site where some Virus differs from the reference'''
+    import numpy as np
+    counts = np.zeros(len(reference))
+    for virus in viruses:
+        row = dict(virus.neutral_d)
+        row.update(virus.beneficial_d)
+        for (pos,mut) in row.items():
+            counts[pos] += mut != reference[pos]
+    return counts[counts > 0] / max(len(viruses), 1)
+
+def simulateViralEvolution(genomeSize, initSize, gens, mutRate, probBen, r, w, x, maxPopSize = 1e7, maxBenSize = 1e7, print_per_gen = 1, stop = None):
 
     import random
     import numpy as np
     import time
-    from virus import Virus, Population
+    from virus import Virus, Population, SparseMutations
     from copy import deepcopy,copy
 
     start_time = time.time()
@@ -18,31 +67,14 @@ def simulateViralEvolution(genomeSize, initSize, gens, mutRate, probBen, r, w, x
     track_ben = []
     track_neut = []
     if print_per_gen != -1:
-        # Print parameters
-        print("¬¬¬¬¬¬¬¬¬¬¬¬¬¬¬¬")
-        print("Viral simulation")
-        print("¬¬¬¬¬¬¬¬¬¬¬¬¬¬¬¬")
-        print('')
-        print('1/3 Simulation parameters')
-        print('-------------------------')
-        print(f'Genome size (bp): {genomeSize}')
-        print(f'Generations (divisions): {gens}')
-        print(f'Mutation rate (µ): {mutRate}')
-        print(f'Probability of a beneficial mutation: {probBen}')
-        print(f'Viral replication rate (r): {r}')
-        print(f'Viral death rate (x): {x}')
-        print(f'Fitness (1 + s): {w}')
-        print('')
-        print('Replication coefficient neutral viruses : %s' %(r - x))
-        print('Replication coefficient beneficial viruses: %s' %(r - x/w))
-        print('')
+        _printParameters(genomeSize, gens, mutRate, probBen, r, x, w)
 
     for j in range(0, gens+1):
         v1_prev,v2_prev = len(neutral),len(beneficial)
 
         if v1_prev > 0:
             # Update neutral population size
-            neutral_rep = np.int(v1_prev * (r - x))
+            neutral_rep = int(v1_prev * (r - x))
             neutral = [deepcopy(neutral[i]) for i in random.choices(range(len(neutral)), k = neutral_rep)]
             v1_new = len(neutral)
 
@@ -62,7 +94,7 @@ def simulateViralEvolution(genomeSize, initSize, gens, mutRate, probBen, r, w, x
 
         if v2_new > 0:
             # Update beneficial population size
-            beneficial_rep = np.int(len(beneficial) * (r - ( (1/w)*x ))) # Beneficial eliminated slower by a factor of 1/w
+            beneficial_rep = int(len(beneficial) * (r - ( (1/w)*x ))) # Beneficial eliminated slower by a factor of 1/w
             beneficial = [deepcopy(beneficial[i]) for i in random.choices(range(len(beneficial)), k = beneficial_rep)]
             v2_new = len(beneficial)
 
@@ -77,51 +109,351 @@ def simulateViralEvolution(genomeSize, initSize, gens, mutRate, probBen, r, w, x
                 beneficial[i].beneficialMutation(track_ben = track_ben)
         
         if print_per_gen != -1:
-            if j == 0:
-                print('2/3 Growth and rates per generation')
-                print('-----------------------------------')
-                print('{:6s} {:6s} {:6s} {:6s} {:6s}'.format('Gen', 'NP', 'BP', 'rN', 'rB'))
-            else:
-                if j % print_per_gen == 0:
-                    print('{:2d} {:6d} {:5d} {:7.2f} {:6.2f}'.format(j, int(len(neutral)), int(len(beneficial)), v1_new/(v1_prev+1), v2_new/(v2_prev+1)))
+            _printGeneration(j, print_per_gen, len(neutral), len(beneficial), v1_new/(v1_prev+1), v2_new/(v2_prev+1))
+
+        # Abandon the simulation (returns None) if stop(generation, population size, site frequencies) says so
+        if stop is not None:
+            if stop(j, len(neutral) + len(beneficial), lambda: _virusFrequencies(neutral + beneficial, reference)):
+                return None
 
         if (len(beneficial) + len(neutral)) > maxPopSize:
             break 
         if len(beneficial) > maxBenSize:
             break
     
-    sample_matrix = []
-    for i in range(len(neutral)):
-        row = deepcopy(reference)
-        for (pos,mut) in neutral[i].neutral_d.items():
-            row[pos] = mut
-        for (pos,mut) in neutral[i].beneficial_d.items(): # Can remove this; neutral don't have beneficial mutations
-            row[pos] = mut
-        sample_matrix.append(row)
-
-    for i in range(len(beneficial)):
-        row = deepcopy(reference)
-        for (pos,mut) in beneficial[i].neutral_d.items():
-            row[pos] = mut
-        for (pos,mut) in beneficial[i].beneficial_d.items():
-            row[pos] = mut
-        sample_matrix.append(row)
-  
-    all_muts = np.array(sample_matrix)
-                
-    #final_beneficial = [[beneficial[j].neutral[i] if beneficial[j].beneficial[i] == 0 else beneficial[j].beneficial[i] for i in range(0, len(beneficial[j].beneficial))] for j in range(0, len(beneficial))]
-    #final_neutral = [neutral[i].neutral for i in range(0, len(neutral))]
-    #all_muts = np.array(final_beneficial + final_neutral) # (Rows = Samples, Columns = Genome Position)
-    
+    # Mutations are kept sparse; rows are only materialized when sampled
+    all_muts = SparseMutations.fromViruses(neutral + beneficial, reference)
+
     output = Population(r = r, w = w, x = x, probBen = probBen, mutRate = mutRate, genomeSize = genomeSize, initSize = initSize, gens = gens, numberBeneficial = len(beneficial), numberNeutral = len(neutral), mutations = all_muts, reference = reference, positiveLoci = track_ben, neutralLoci = [i for i in track_neut if i not in track_ben])
     
     if print_per_gen != -1:
-        print('')
-        print('3/3 Population description')
-        print('--------------------------')
-        print(f'Number of beneficial viruses: {output.numberBeneficial}')
-        print(f'Number of neutral viruses: {output.numberNeutral}')
-        elapsed_time = time.time() - start_time
-        print('Time elapsed is ',elapsed_time, 'seconds')
-
-    return(output)
\ No newline at end of file
+        _printSummary(output, start_time)
+
+    return(output)
+
+def _addMutations(table, population, indices, genomeSize, beneficial, rng):
+    '''Gives one new mutation to each individual in indices (with repeats chained in order) and returns the updated genotype ids and mutated positions'''
+    import numpy as np
+    indices = np.sort(indices, kind = 'stable')
+    positions = rng.integers(0, genomeSize, size = len(indices))
+    if len(indices) == 0:
+        return (population, positions)
+    parents = population[indices]
+    if beneficial:
+        # Beneficial base differs from the neutral base already carried at that position
+        current = table.neutralBase(parents, positions)
+        bases = rng.integers(1, 4, size = len(indices))
+        bases = np.where(current > 0, bases + (bases >= current), rng.integers(1, 5, size = len(indices)))
+    else:
+        bases = rng.integers(1, 5, size = len(indices))
+    ids = np.arange(table.size, table.size + len(indices))
+    repeat = np.flatnonzero(np.r_[False, indices[1:] == indices[:-1]])
+    parents[repeat] = ids[repeat - 1]
+    table.add(parents, positions, bases, beneficial)
+    last = np.r_[indices[1:] != indices[:-1], True]
+    population = population.copy()
+    population[indices[last]] = ids[last]
+    return (population, positions)
+
+def _tableFrequencies(table, genotypes, counts, reference):
+    '''Population frequency of every site where some genotype (with abundance counts, or one individual each) differs from the reference'''
+    import numpy as np
+    counts = np.ones(len(genotypes)) if counts is None else counts
+    genotypes, inverse = np.unique(genotypes, return_inverse = True)
+    counts = np.bincount(inverse, weights = counts, minlength = len(genotypes))
+    row, position, base = table.applied(genotypes, len(reference))
+    derived = base != np.asarray(reference)[position]
+    frequencies = np.bincount(position[derived], weights = counts[row[derived]], minlength = len(reference))
+    return frequencies[frequencies > 0] / max(np.sum(counts), 1)
+
+def _pruneTable(table, neutral, beneficial):
+    '''Removes extinct lineages from the table and relabels the surviving genotype ids'''
+    import numpy as np
+    genotypes = table.prune(np.concatenate((neutral, beneficial)))
+    return (genotypes[:len(neutral)], genotypes[len(neutral):])
+
+def saveSnapshot(path, engine, generation, params, population, table, reference, track_neut, track_ben, rng):
+    '''Writes the full state of an array-based simulation after a generation to a compressed .npz snapshot'''
+    import numpy as np
+    import json
+    import os
+    arrays = {'population_' + key: value for (key, value) in population.items()}
+    tmp = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez_compressed(f, engine = engine, generation = generation, params = json.dumps(params), rng = json.dumps(rng.bit_generator.state), reference = reference,
+            table_parent = table.parent[:table.size], table_position = table.position[:table.size], table_base = table.base[:table.size], table_beneficial = table.beneficial[:table.size],
+            track_neut = np.concatenate([np.zeros(0, dtype = np.int64)] + track_neut), track_ben = np.concatenate([np.zeros(0, dtype = np.int64)] + track_ben), **arrays)
+    os.replace(tmp, path)
+
+def loadSnapshot(path):
+    '''Reads a snapshot written by saveSnapshot into a dictionary that can be passed as resume= to the engine that wrote it'''
+    import numpy as np
+    import json
+    with np.load(path, allow_pickle = False) as f:
+        snapshot = {key: f[key] for key in f.files}
+    snapshot['engine'] = str(snapshot['engine'])
+    snapshot['generation'] = int(snapshot['generation'])
+    snapshot['params'] = json.loads(str(snapshot['params']))
+    snapshot['rng'] = json.loads(str(snapshot['rng']))
+    return snapshot
+
+def _restoreSnapshot(snapshot, engine, genomeSize, initSize, rng, seed):
+    '''Rebuilds (population, table, reference, track_neut, track_ben, first generation) from a snapshot. The RNG continues the saved stream unless a new seed is given'''
+    from virus import MutationTable
+    snapshot = loadSnapshot(snapshot) if isinstance(snapshot, str) else snapshot
+    if snapshot['engine'] != engine:
+        raise ValueError('Snapshot was written by ' + snapshot['engine'] + ', not ' + engine)
+    if snapshot['params']['genomeSize'] != genomeSize or snapshot['params']['initSize'] != initSize:
+        raise ValueError('genomeSize and initSize must match the snapshot')
+    table = MutationTable(capacity = len(snapshot['table_parent']))
+    table.size = len(snapshot['table_parent'])
+    table.parent[:], table.position[:], table.base[:], table.beneficial[:] = snapshot['table_parent'], snapshot['table_position'], snapshot['table_base'], snapshot['table_beneficial']
+    if seed is None:
+        rng.bit_generator.state = snapshot['rng']
+    population = {key[len('population_'):]: snapshot[key].copy() for key in snapshot if key.startswith('population_')}
+    return (population, table, snapshot['reference'].copy(), [snapshot['track_neut'].copy()], [snapshot['track_ben'].copy()], snapshot['generation'] + 1)
+
+def _runContinuation(task):
+    snapshot, kwargs = task
+    engine = {'vectorized': simulateViralEvolutionVectorized, 'clone': simulateViralEvolutionClones}[kwargs.pop('engine')]
+    return engine(resume = snapshot, **kwargs)
+
+def forkSimulation(snapshot, continuations, workers = 1):
+    '''Runs one continuation per dictionary in continuations (e.g. different w, probBen, mutRate or seed) from the same snapshot, in process or on a pool of workers.
+    Parameters not given in a continuation are taken from the snapshot. Continuations run silently (print_per_gen = -1) unless they set print_per_gen. Returns the list of Populations'''
+    from concurrent.futures import ProcessPoolExecutor
+    saved = loadSnapshot(snapshot) if isinstance(snapshot, str) else snapshot
+    tasks = []
+    for continuation in continuations:
+        kwargs = dict(saved['params'], engine = saved['engine'], print_per_gen = -1) # Per-generation tables of parallel continuations would interleave
+        kwargs.update(continuation)
+        tasks.append((snapshot, kwargs))
+    if workers <= 1:
+        return [_runContinuation(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        return list(pool.map(_runContinuation, tasks))
+
+def simulateViralEvolutionVectorized(genomeSize, initSize, gens, mutRate, probBen, r, w, x, maxPopSize = 1e7, maxBenSize = 1e7, print_per_gen = 1, seed = None, genealogy = False, stop = None, snapshotGen = None, snapshotPath = None, resume = None):
+    '''Same birth-death process as simulateViralEvolution, but individuals are genotype ids into a shared MutationTable so each generation is a handful of array operations.
+    With genealogy = True the mutation tree is returned as is (Population.mutations is a Lineages object) and haplotypes are only rebuilt for the rows that are sampled,
+    otherwise the mutations of every individual are returned as a SparseMutations matrix.
+    stop(generation, population size, frequencies) is checked after every generation, where frequencies() returns the population frequency of every site carrying a derived allele;
+    if it returns True the simulation is abandoned and None is returned.
+    snapshotGen/snapshotPath save the state after that generation with saveSnapshot; resume (a snapshot path or loadSnapshot dictionary) continues a saved run from the next
+    generation with the parameters given here, using the saved random stream unless seed is set'''
+
+    import numpy as np
+    import time
+    from virus import MutationTable, Population, Lineages
+
+    start_time = time.time()
+    rng = np.random.default_rng(seed)
+
+    params = dict(genomeSize = genomeSize, initSize = initSize, gens = gens, mutRate = mutRate, probBen = probBen, r = r, w = w, x = x, maxPopSize = maxPopSize, maxBenSize = maxBenSize)
+
+    # Initialize
+    if resume is None:
+        reference = rng.integers(1, 5, size = genomeSize)
+        table = MutationTable()
+        neutral = np.zeros(initSize, dtype = np.int64)
+        beneficial = np.zeros(0, dtype = np.int64)
+        track_ben = []
+        track_neut = []
+        first = 0
+    else:
+        population, table, reference, track_neut, track_ben, first = _restoreSnapshot(resume, 'vectorized', genomeSize, initSize, rng, seed)
+        neutral, beneficial = population['neutral'], population['beneficial']
+    pruned_size = table.size
+    if print_per_gen != -1:
+        _printParameters(genomeSize, gens, mutRate, probBen, r, x, w)
+
+    for j in range(first, gens+1):
+        # Drop extinct lineages once the table has doubled since the last pruning
+        if table.size > 2 * pruned_size + 1024:
+            neutral, beneficial = _pruneTable(table, neutral, beneficial)
+            pruned_size = table.size
+
+        v1_prev,v2_prev = len(neutral),len(beneficial)
+        v1_new,v2_new = v1_prev,v2_prev
+
+        if v1_prev > 0:
+            # Update neutral population size
+            neutral = neutral[rng.integers(0, v1_prev, size = int(v1_prev * (r - x)))]
+            v1_new = len(neutral)
+
+            # Add neutral mutations based on mutRate
+            neutral_mut_ind = rng.integers(0, v1_new, size = rng.poisson(mutRate * v1_new))
+            neutral, loci = _addMutations(table, neutral, neutral_mut_ind, genomeSize, False, rng)
+            track_neut.append(loci)
+
+            # Conversion to beneficial class at rate of mutRate * probBen
+            new_ben_ind = rng.integers(0, v1_new, size = rng.poisson(mutRate * probBen * v1_new))
+            neutral, loci = _addMutations(table, neutral, new_ben_ind, genomeSize, True, rng)
+            track_ben.append(loci)
+            beneficial = np.concatenate((beneficial, neutral[new_ben_ind]))
+            v2_new = len(beneficial)
+            converted = np.zeros(v1_new, dtype = bool)
+            converted[new_ben_ind] = True
+            neutral = neutral[~converted]
+
+        if v2_new > 0:
+            # Update beneficial population size
+            beneficial = beneficial[rng.integers(0, v2_new, size = int(v2_new * (r - ( (1/w)*x ))))] # Beneficial eliminated slower by a factor of 1/w
+            v2_new = len(beneficial)
+
+            # Add neutral mutations to beneficial viruses
+            neut_ben_mut_ind = rng.integers(0, v2_new, size = rng.poisson(mutRate * v2_new))
+            beneficial, loci = _addMutations(table, beneficial, neut_ben_mut_ind, genomeSize, False, rng)
+            track_neut.append(loci)
+
+            # Add beneficial mutations to beneficial viruses
+            ben_mut_ind = rng.integers(0, v2_new, size = rng.poisson(mutRate * probBen * v2_new))
+            beneficial, loci = _addMutations(table, beneficial, ben_mut_ind, genomeSize, True, rng)
+            track_ben.append(loci)
+
+        if print_per_gen != -1:
+            _printGeneration(j, print_per_gen, len(neutral), len(beneficial), v1_new/(v1_prev+1), v2_new/(v2_prev+1))
+
+        if stop is not None:
+            if stop(j, len(neutral) + len(beneficial), lambda: _tableFrequencies(table, np.concatenate((neutral, beneficial)), None, reference)):
+                return None
+
+        if j == snapshotGen:
+            saveSnapshot(snapshotPath, 'vectorized', j, params, dict(neutral = neutral, beneficial = beneficial), table, reference, track_neut, track_ben, rng)
+
+        if (len(beneficial) + len(neutral)) > maxPopSize:
+            break
+        if len(beneficial) > maxBenSize:
+            break
+
+    neutral, beneficial = _pruneTable(table, neutral, beneficial)
+    all_muts = Lineages(table, np.concatenate((neutral, beneficial)), reference)
+    if not genealogy:
+        all_muts = table.sparse(all_muts.genotypes, reference)
+
+    track_ben = np.concatenate([np.zeros(0, dtype = np.int64)] + track_ben).tolist()
+    track_neut = np.concatenate([np.zeros(0, dtype = np.int64)] + track_neut).tolist()
+    positive = set(track_ben)
+    output = Population(r = r, w = w, x = x, probBen = probBen, mutRate = mutRate, genomeSize = genomeSize, initSize = initSize, gens = gens, numberBeneficial = len(beneficial), numberNeutral = len(neutral), mutations = all_muts, reference = reference.tolist(), positiveLoci = track_ben, neutralLoci = [i for i in track_neut if i not in positive])
+
+    if print_per_gen != -1:
+        _printSummary(output, start_time)
+
+    return(output)
+
+
+def _splitClones(table, genotypes, counts, events, genomeSize, beneficial, rng):
+    '''Spreads events over clones in proportion to abundance and splits each hit individual off into a new single-individual clone carrying one new mutation.
+    Returns the remaining clones, the new clones and the mutated positions'''
+    import numpy as np
+    hits = np.minimum(rng.multinomial(events, counts / counts.sum()), counts) if events > 0 else np.zeros(len(counts), dtype = np.int64)
+    parents = np.repeat(genotypes, hits)
+    new, positions = _addMutations(table, parents, np.arange(len(parents)), genomeSize, beneficial, rng)
+    return (counts - hits, new, positions)
+
+def _dropEmpty(genotypes, counts):
+    keep = counts > 0
+    return (genotypes[keep], counts[keep])
+
+def simulateViralEvolutionClones(genomeSize, initSize, gens, mutRate, probBen, r, w, x, maxPopSize = 1e7, maxBenSize = 1e7, print_per_gen = 1, seed = None, stop = None, snapshotGen = None, snapshotPath = None, resume = None):
+    '''Clone-count (multitype branching) version of simulateViralEvolution. Identical individuals are stored once as a genotype with an abundance, replication is a
+    multinomial draw over clones and each mutation splits one individual off its clone. Individuals receive at most one mutation of each kind per generation.
+    stop, snapshotGen, snapshotPath and resume behave as in simulateViralEvolutionVectorized'''
+
+    import numpy as np
+    import time
+    from virus import MutationTable, Population, Lineages
+
+    start_time = time.time()
+    rng = np.random.default_rng(seed)
+
+    params = dict(genomeSize = genomeSize, initSize = initSize, gens = gens, mutRate = mutRate, probBen = probBen, r = r, w = w, x = x, maxPopSize = maxPopSize, maxBenSize = maxBenSize)
+
+    # Initialize
+    if resume is None:
+        reference = rng.integers(1, 5, size = genomeSize)
+        table = MutationTable()
+        neutral, neutral_n = np.zeros(1, dtype = np.int64), np.array([initSize])
+        beneficial, beneficial_n = np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+        track_ben = []
+        track_neut = []
+        first = 0
+    else:
+        population, table, reference, track_neut, track_ben, first = _restoreSnapshot(resume, 'clone', genomeSize, initSize, rng, seed)
+        neutral, neutral_n, beneficial, beneficial_n = population['neutral'], population['neutral_n'], population['beneficial'], population['beneficial_n']
+    pruned_size = table.size
+    if print_per_gen != -1:
+        _printParameters(genomeSize, gens, mutRate, probBen, r, x, w)
+
+    for j in range(first, gens+1):
+        if table.size > 2 * pruned_size + 1024:
+            neutral, beneficial = _pruneTable(table, neutral, beneficial)
+            pruned_size = table.size
+
+        v1_prev,v2_prev = int(neutral_n.sum()),int(beneficial_n.sum())
+        v1_new,v2_new = v1_prev,v2_prev
+
+        if v1_prev > 0:
+            # Update neutral population size
+            neutral_n = rng.multinomial(int(v1_prev * (r - x)), neutral_n / v1_prev)
+            neutral, neutral_n = _dropEmpty(neutral, neutral_n)
+            v1_new = int(neutral_n.sum())
+
+        if v1_new > 0:
+            # Add neutral mutations based on mutRate
+            neutral_n, new, loci = _splitClones(table, neutral, neutral_n, rng.poisson(mutRate * v1_new), genomeSize, False, rng)
+            neutral, neutral_n = np.concatenate((neutral, new)), np.concatenate((neutral_n, np.ones(len(new), dtype = np.int64)))
+            track_neut.append(loci)
+
+            # Conversion to beneficial class at rate of mutRate * probBen
+            neutral_n, new, loci = _splitClones(table, neutral, neutral_n, rng.poisson(mutRate * probBen * v1_new), genomeSize, True, rng)
+            beneficial, beneficial_n = np.concatenate((beneficial, new)), np.concatenate((beneficial_n, np.ones(len(new), dtype = np.int64)))
+            track_ben.append(loci)
+            neutral, neutral_n = _dropEmpty(neutral, neutral_n)
+            v1_new, v2_new = int(neutral_n.sum()), int(beneficial_n.sum())
+
+        if v2_new > 0:
+            # Update beneficial population size
+            beneficial_n = rng.multinomial(int(v2_new * (r - ( (1/w)*x ))), beneficial_n / v2_new) # Beneficial eliminated slower by a factor of 1/w
+            beneficial, beneficial_n = _dropEmpty(beneficial, beneficial_n)
+            v2_new = int(beneficial_n.sum())
+
+        if v2_new > 0:
+            # Add neutral mutations to beneficial viruses
+            beneficial_n, new, loci = _splitClones(table, beneficial, beneficial_n, rng.poisson(mutRate * v2_new), genomeSize, False, rng)
+            beneficial, beneficial_n = np.concatenate((beneficial, new)), np.concatenate((beneficial_n, np.ones(len(new), dtype = np.int64)))
+            track_neut.append(loci)
+
+            # Add beneficial mutations to beneficial viruses
+            beneficial_n, new, loci = _splitClones(table, beneficial, beneficial_n, rng.poisson(mutRate * probBen * v2_new), genomeSize, True, rng)
+            beneficial, beneficial_n = np.concatenate((beneficial, new)), np.concatenate((beneficial_n, np.ones(len(new), dtype = np.int64)))
+            track_ben.append(loci)
+            beneficial, beneficial_n = _dropEmpty(beneficial, beneficial_n)
+
+        if print_per_gen != -1:
+            _printGeneration(j, print_per_gen, v1_new, v2_new, v1_new/(v1_prev+1), v2_new/(v2_prev+1))
+
+        if stop is not None:
+            if stop(j, v1_new + v2_new, lambda: _tableFrequencies(table, np.concatenate((neutral, beneficial)), np.concatenate((neutral_n, beneficial_n)), reference)):
+                return None
+
+        if j == snapshotGen:
+            saveSnapshot(snapshotPath, 'clone', j, params, dict(neutral = neutral, neutral_n = neutral_n, beneficial = beneficial, beneficial_n = beneficial_n), table, reference, track_neut, track_ben, rng)
+
+        if (v1_new + v2_new) > maxPopSize:
+            break
+        if v2_new > maxBenSize:
+            break
+
+    neutral, beneficial = _pruneTable(table, neutral, beneficial)
+    all_muts = Lineages(table, np.concatenate((neutral, beneficial)), reference, counts = np.concatenate((neutral_n, beneficial_n)))
+
+    track_ben = np.concatenate([np.zeros(0, dtype = np.int64)] + track_ben).tolist()
+    track_neut = np.concatenate([np.zeros(0, dtype = np.int64)] + track_neut).tolist()
+    positive = set(track_ben)
+    output = Population(r = r, w = w, x = x, probBen = probBen, mutRate = mutRate, genomeSize = genomeSize, initSize = initSize, gens = gens, numberBeneficial = int(beneficial_n.sum()), numberNeutral = int(neutral_n.sum()), mutations = all_muts, reference = reference.tolist(), positiveLoci = track_ben, neutralLoci = [i for i in track_neut if i not in positive])
+
+    if print_per_gen != -1:
+        _printSummary(output, start_time)
+
+    return(output)
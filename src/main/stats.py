@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+''' Description: Population genetics summary statistics (Watterson's theta, Tajima's pi, Tajima's D and Fay and Wu's H) computed for whole stacks of haplotype images at once.
+The constants that only depend on the sample size are computed once per sample size '''
+
+from functools import lru_cache
+
+NAN = (float('nan'), float('nan'))
+
+@lru_cache(maxsize = None)
+def constants(n):
+    '''Sample-size dependent constants of the estimators and of the variances of Tajima's D and Fay and Wu's H'''
+    import numpy as np
+    i = np.arange(1, n)
+    a1 = np.sum(1 / i)
+    a2 = np.sum(1 / (i * i))
+    bn1 = np.sum(1 / (np.arange(1, n + 1) ** 2))
+    b1 = (n + 1) / (3 * (n - 1))
+    b2 = (2 * ((n*n) + n + 3)) / (9 * n * (n - 1))
+    c1 = b1 - (1 / a1)
+    c2 = b2 - ((n + 2) / (a1 * n)) + (a2 / (a1*a1))
+    return {'a1': a1, 'a2': a2, 'pairs': n * (n - 1) / 2, 'e1': c1 / a1, 'e2': c2 / ((a1*a1) + a2),
+        'h1': (n - 2) / (6 * (n - 1)), 'h2': ((18 * (n*n) * (3 * n + 2) * bn1) - (88 * (n*n*n) + 9 * (n*n) - 13*n + 6)) / (9 * n * ((n - 1)*(n-1)))}
+
+def siteTerms(counts, n = 200, legacy = False):
+    '''Per-site terms of the estimators from derived allele counts per site: whether the site segregates, p(1 - p) and p (zero at sites that do not segregate).
+    The legacy version counts sites as segregating below 200 copies whatever n is'''
+    import numpy as np
+    counts = np.asarray(counts)
+    segregating = (counts > 0) & (counts < (200 if legacy else n))
+    p = np.where(segregating, counts / n, 0)
+    return (segregating, p * (1 - p), p)
+
+def siteSums(counts, n = 200, legacy = False):
+    '''Number of segregating sites S, sum of p(1 - p) and sum of p over the segregating sites, from derived allele counts per site (last axis)'''
+    segregating, pq, p = siteTerms(counts, n, legacy)
+    return (segregating.sum(axis = -1), pq.sum(axis = -1), p.sum(axis = -1))
+
+def windowStats(counts, windows, n = 200, legacy = False, empty = NAN):
+    '''Statistics of neutralityTests for every window [index1, index2) in windows, from derived allele counts per site over the whole genome (last axis, e.g. one row
+    per subsample). The site terms are accumulated once, so each window costs two lookups in the prefix sums whatever its length'''
+    import numpy as np
+    windows = np.asarray(windows)
+    sums = []
+    for term in siteTerms(counts, n, legacy):
+        prefix = np.cumsum(term, axis = -1, dtype = float)
+        prefix = np.concatenate((np.zeros(prefix.shape[:-1] + (1,)), prefix), axis = -1)
+        sums.append(prefix[..., windows[:,1]] - prefix[..., windows[:,0]])
+    S, pq, p = sums
+    return dict(S = np.rint(S).astype(np.int64), **neutralityTests(S, pq, p, n, legacy, empty))
+
+def neutralityTests(S, pq, p, n = 200, legacy = False, empty = NAN):
+    '''Watterson's theta, Tajima's pi, Tajima's D and Fay and Wu's H from the site sums of siteSums. Images without segregating sites get the values in empty.
+    legacy = True reproduces the earlier popgenStats, which scaled pi by n^2 (bitwise XOR, i.e. n + 2 for even n) instead of n*n'''
+    import numpy as np
+    k = constants(n)
+    S, pq, p = np.asarray(S, dtype = float), np.asarray(pq), np.asarray(p)
+    theta_w = S / k['a1']
+    theta_pi = pq * ((n^2) if legacy else (n*n)) / k['pairs']
+    theta_l = p * (n / (n - 1))
+    theta2 = (S * (S - 1)) / ((k['a1']*k['a1']) + k['a2'])
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        TajimasD = (theta_pi - theta_w) / np.sqrt((k['e1'] * S) + ((k['e2'] * S) * (S - 1)))
+        WuH = 2 * ((theta_pi - theta_l) / np.sqrt((k['h1'] * theta_w) + (theta2 * k['h2'])))
+    TajimasD = np.where(S > 0, TajimasD, empty[0])
+    WuH = np.where(S > 0, WuH, empty[1])
+    return {'theta_w': theta_w[()], 'theta_pi': theta_pi[()], 'tajimas_d': TajimasD[()], 'fay_wu_h': WuH[()]}
+
+def summaryStats(haplotypes, n = 200, legacy = False, empty = NAN):
+    '''Segregating sites, Watterson's theta, Tajima's pi, Tajima's D and Fay and Wu's H of an image or of every image of a (batch, rows, cols) stack'''
+    import numpy as np
+    S, pq, p = siteSums(np.asarray(haplotypes).sum(axis = -2, dtype = np.int64), n, legacy)
+    return dict(S = S, **neutralityTests(S, pq, p, n, legacy, empty))
+
+def popgenStats(haplotypes, n = 200, legacy = False, empty = NAN):
+    '''[Tajima's D, Fay and Wu's H] of an image, or arrays of both over a (batch, rows, cols) stack'''
+    stats = summaryStats(haplotypes, n, legacy, empty)
+    return [stats['tajimas_d'], stats['fay_wu_h']]
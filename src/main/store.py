@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+''' Description: Consolidated training store. Packs thousands of simulated images into a few large shard files of bit-packed records, with an offset index and a
+label/parameter table, and reads random subsets of it back through np.memmap '''
+
+import argparse
+import json
+import os
+
+def _parseName(name):
+    '''Simulation parameters encoded in exec.py file names (size_u_p_fitness_seed_id)'''
+    fields = os.path.splitext(name)[0].split('_')
+    try:
+        return {'window': int(fields[0]), 'u': float(fields[1]), 'p': float(fields[2]), 'w': float(fields[3])}
+    except (IndexError, ValueError):
+        return {}
+
+def packStore(directories, output, shardSize = 2**30):
+    '''Packs the images in each directory of directories ({label: directory}) into output. Every image becomes one fixed-size record of packed bits; records are
+    appended to shard_<k>.bin files of at most shardSize bytes. Writes index.npy (shard and byte offset of each record), labels.csv (file, image, label and simulation
+    parameters of each record) and store.json (image shape and record layout)'''
+    import numpy as np
+    import pandas as pd
+    from model import loadHaplotypes
+    os.makedirs(output, exist_ok = True)
+    shape, record, perShard = None, None, None
+    shards, offsets, rows = [], [], []
+    f = None
+    for label, directory in directories.items():
+        for name in sorted(os.listdir(directory)):
+            haplotypes, params = loadHaplotypes(os.path.join(directory, name), params = True)
+            haplotypes = haplotypes.reshape((-1,) + haplotypes.shape[-2:])
+            if shape is None:
+                shape = haplotypes.shape[1:]
+                record = shape[0] * ((shape[1] + 7) // 8)
+                perShard = max(1, shardSize // record)
+            elif haplotypes.shape[1:] != shape:
+                raise ValueError(name + ' has images of shape ' + str(haplotypes.shape[1:]) + ', the store holds ' + str(shape))
+            params = dict(_parseName(name), **params)
+            for k, image in enumerate(haplotypes):
+                i = len(shards)
+                if i % perShard == 0:
+                    if f is not None:
+                        f.close()
+                    f = open(os.path.join(output, 'shard_' + str(i // perShard).zfill(5) + '.bin'), 'wb')
+                f.write(np.packbits(image.astype(bool), axis = -1).tobytes())
+                shards.append(i // perShard)
+                offsets.append((i % perShard) * record)
+                rows.append(dict(file = name, image = k, label = label, **params))
+    if f is not None:
+        f.close()
+    if shape is None:
+        raise ValueError('No images found in ' + ', '.join(directories.values()))
+    index = np.zeros(len(shards), dtype = [('shard', np.int32), ('offset', np.int64)])
+    index['shard'], index['offset'] = shards, offsets
+    np.save(os.path.join(output, 'index.npy'), index)
+    pd.DataFrame(rows).to_csv(os.path.join(output, 'labels.csv'), index = False)
+    with open(os.path.join(output, 'store.json'), 'w') as f:
+        json.dump({'shape': list(shape), 'record': record, 'records_per_shard': perShard, 'size': len(shards), 'shards': shards[-1] + 1}, f)
+    return HaplotypeStore(output)
+
+class HaplotypeStore:
+    '''Read-only view of a store written by packStore. Shards are memory-mapped, so only the records that are read are paged in'''
+    def __init__(self, directory):
+        import numpy as np
+        import pandas as pd
+        self.directory = directory
+        with open(os.path.join(directory, 'store.json')) as f:
+            layout = json.load(f)
+        self.shape = tuple(layout['shape'])
+        self.record = layout['record']
+        self.index = np.load(os.path.join(directory, 'index.npy'))
+        self.labels = pd.read_csv(os.path.join(directory, 'labels.csv'))
+        self.shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def shard(self, k):
+        '''Memory map of shard k as (records, rows, packed columns)'''
+        import numpy as np
+        if k not in self.shards:
+            path = os.path.join(self.directory, 'shard_' + str(k).zfill(5) + '.bin')
+            self.shards[k] = np.memmap(path, dtype = np.uint8, mode = 'r').reshape((-1, self.shape[0], self.record // self.shape[0]))
+        return self.shards[k]
+
+    def packed(self, indices):
+        '''Packed records of the images in indices (read shard by shard in offset order)'''
+        import numpy as np
+        indices = np.asarray(indices, dtype = np.int64)
+        out = np.empty((len(indices), self.shape[0], self.record // self.shape[0]), dtype = np.uint8)
+        shards, offsets = self.index['shard'][indices], self.index['offset'][indices]
+        for k in np.unique(shards):
+            where = np.nonzero(shards == k)[0]
+            where = where[np.argsort(offsets[where], kind = 'stable')]
+            out[where] = self.shard(k)[offsets[where] // self.record]
+        return out
+
+    def images(self, indices):
+        '''Images in indices as uint8 arrays of shape (len(indices), rows, columns)'''
+        import numpy as np
+        return np.unpackbits(self.packed(indices), axis = -1, count = self.shape[1])
+
+    def sample(self, label, n, rng = None):
+        '''Indices of n records with the given label drawn without replacement'''
+        import numpy as np
+        import random
+        candidates = np.nonzero((self.labels['label'] == label).values)[0]
+        if rng is None:
+            return np.array(random.sample(candidates.tolist(), k = n), dtype = np.int64)
+        return rng.choice(candidates, size = n, replace = False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Packs simulated images into a training store')
+    parser.add_argument('-pos', '--positive', help='Directory storing positive simulated data')
+    parser.add_argument('-neu', '--neutral', help='Directory storing neutral simulated data')
+    parser.add_argument('-out', '--output', help='Store directory')
+    parser.add_argument('-ss', '--shard_size', default = 1, type = float, help='Maximum shard size (GB)')
+    # Example argument
+    # - python3 store.py -pos positive/ -neu neutral/ -out store/
+    args = parser.parse_args()
+    store = packStore({'positive': args.positive, 'neutral': args.neutral}, args.output, shardSize = int(args.shard_size * 2**30))
+    print('Packed ' + str(len(store)) + ' images of shape ' + str(store.shape) + ' into ' + str(int(store.index['shard'].max()) + 1) + ' shards')
@@ -5,6 +5,7 @@ import random
 import time
 import cProfile
 import re
+import numpy as np
 
 class Virus:
     def __init__(self, genomeSize):
@@ -50,4 +51,176 @@ class Population:
         self.mutations = mutations
         self.reference = reference
         self.positiveLoci = positiveLoci
-        self.neutralLoci = neutralLoci
\ No newline at end of file
+        self.neutralLoci = neutralLoci
+
+    def dense(self, rows, cols = None):
+        '''Haplotypes (genome positions as bases) of the individuals in rows, restricted to the genome positions in cols. Only this block is materialized'''
+        if isinstance(self.mutations, np.ndarray):
+            return self.mutations[rows,:] if cols is None else self.mutations[np.ix_(np.asarray(rows), np.arange(self.mutations.shape[1])[cols])]
+        return self.mutations.dense(rows, cols)
+
+    def sample(self, rows):
+        '''Full-genome haplotypes of the individuals in rows'''
+        return self.dense(rows)
+
+class MutationTable:
+    '''Genotypes shared across a population. Each genotype is its parent genotype plus one mutation; genotype 0 is the unmutated reference'''
+    def __init__(self, capacity = 1024):
+        self.parent = np.full(capacity, -1, dtype = np.int64)
+        self.position = np.full(capacity, -1, dtype = np.int64)
+        self.base = np.zeros(capacity, dtype = np.int64)
+        self.beneficial = np.zeros(capacity, dtype = bool)
+        self.size = 1
+
+    def add(self, parents, positions, bases, beneficial):
+        '''Appends one genotype per mutation and returns the new genotype ids'''
+        k = len(parents)
+        if self.size + k > len(self.parent):
+            capacity = max(2 * len(self.parent), self.size + k)
+            for attr in ['parent', 'position', 'base', 'beneficial']:
+                old = getattr(self, attr)
+                new = np.zeros(capacity, dtype = old.dtype)
+                new[:self.size] = old[:self.size]
+                setattr(self, attr, new)
+        ids = np.arange(self.size, self.size + k)
+        self.parent[ids] = parents
+        self.position[ids] = positions
+        self.base[ids] = bases
+        self.beneficial[ids] = beneficial
+        self.size += k
+        return ids
+
+    def neutralBase(self, ids, positions):
+        '''Most recent neutral base carried at each position by each genotype (0 if the position carries no neutral mutation)'''
+        bases = np.zeros(len(ids), dtype = np.int64)
+        current, active = np.asarray(ids, dtype = np.int64).copy(), np.arange(len(ids))
+        positions = np.asarray(positions)
+        while len(active) > 0:
+            keep = current > 0
+            current, active = current[keep], active[keep]
+            hit = (self.position[current] == positions[active]) & ~self.beneficial[current]
+            bases[active[hit]] = self.base[current[hit]]
+            current, active = self.parent[current[~hit]], active[~hit]
+        return bases
+
+    def prune(self, ids):
+        '''Drops genotypes without surviving descendants and returns ids relabelled into the compacted table'''
+        keep = np.zeros(self.size, dtype = bool)
+        keep[0] = True
+        current = np.unique(ids)
+        while len(current) > 0:
+            current = current[~keep[current]]
+            keep[current] = True
+            current = np.unique(self.parent[current])
+            current = current[current >= 0]
+        relabel = np.cumsum(keep) - 1
+        parent = self.parent[:self.size][keep]
+        self.parent = np.where(parent >= 0, relabel[parent], -1)
+        self.position = self.position[:self.size][keep]
+        self.base = self.base[:self.size][keep]
+        self.beneficial = self.beneficial[:self.size][keep]
+        self.size = len(self.parent)
+        return relabel[ids]
+
+    def mutations(self, ids):
+        '''Walks every genotype back to the reference and returns (row, genotype, position, base, beneficial) for each mutation it carries'''
+        rows, genotypes = [], []
+        current, row = np.asarray(ids, dtype = np.int64), np.arange(len(ids))
+        while len(current) > 0:
+            keep = current > 0
+            current, row = current[keep], row[keep]
+            rows.append(row)
+            genotypes.append(current)
+            current = self.parent[current]
+        row, genotype = np.concatenate(rows), np.concatenate(genotypes)
+        return (row, genotype, self.position[genotype], self.base[genotype], self.beneficial[genotype])
+
+    def applied(self, ids, genomeSize):
+        '''Final (row, position, base) of every mutation carried by each genotype in ids, sorted by row and position. Neutral mutations are applied in the order they arose, then beneficial mutations, as in Virus'''
+        row, genotype, position, base, beneficial = self.mutations(ids)
+        order = np.lexsort((genotype, beneficial))[::-1] # Last applied mutation first
+        _, last = np.unique(row[order] * genomeSize + position[order], return_index = True)
+        last = order[last]
+        return (row[last], position[last], base[last])
+
+    def haplotypes(self, ids, reference, cols = None):
+        '''Materializes the genome (or the columns in cols) of each genotype in ids'''
+        reference = np.asarray(reference)
+        row, position, base = self.applied(ids, len(reference))
+        return _overlay(reference, len(ids), row, position, base, cols)
+
+    def sparse(self, ids, reference):
+        '''Mutations of each genotype in ids as a SparseMutations matrix'''
+        row, position, base = self.applied(ids, len(reference))
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(row, minlength = len(ids)))))
+        return SparseMutations(indptr, position, base, reference)
+
+
+def _overlay(reference, nrows, row, position, base, cols = None):
+    '''Reference rows (restricted to cols) with the given mutations written over them'''
+    if cols is None:
+        matrix = np.tile(reference, (nrows, 1))
+        matrix[row, position] = base
+        return matrix
+    cols = np.arange(len(reference))[cols]
+    unique, inverse = np.unique(cols, return_inverse = True)
+    column = np.full(len(reference), -1, dtype = np.int64)
+    column[unique] = np.arange(len(unique))
+    matrix = np.tile(reference[unique], (nrows, 1))
+    inside = column[position] >= 0
+    matrix[row[inside], column[position[inside]]] = base[inside]
+    if len(unique) == len(cols) and np.all(unique == cols):
+        return matrix
+    return matrix[:, inverse]
+
+
+class SparseMutations:
+    '''Population mutations in compressed sparse row form: the mutations of individual i are position[indptr[i]:indptr[i+1]] with bases base[indptr[i]:indptr[i+1]]'''
+    def __init__(self, indptr, position, base, reference):
+        self.indptr = np.asarray(indptr, dtype = np.int64)
+        self.position = np.asarray(position, dtype = np.int64)
+        self.base = np.asarray(base, dtype = np.int8)
+        self.reference = np.asarray(reference)
+        self.shape = (len(self.indptr) - 1, len(self.reference))
+
+    @classmethod
+    def fromViruses(cls, viruses, reference):
+        '''Builds the matrix from Virus objects; beneficial mutations take precedence over neutral ones at the same position'''
+        indptr, position, base = [0], [], []
+        for virus in viruses:
+            row = dict(virus.neutral_d)
+            row.update(virus.beneficial_d)
+            position += list(row.keys())
+            base += list(row.values())
+            indptr.append(len(position))
+        return cls(indptr, position, base, reference)
+
+    def dense(self, rows, cols = None):
+        rows = np.asarray(rows, dtype = np.int64)
+        starts, lengths = self.indptr[rows], self.indptr[rows + 1] - self.indptr[rows]
+        entries = np.arange(np.sum(lengths)) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+        return _overlay(self.reference, len(rows), np.repeat(np.arange(len(rows)), lengths), self.position[entries], self.base[entries], cols)
+
+    def sample(self, rows):
+        return self.dense(rows)
+
+
+class Lineages:
+    '''Population kept as genotype ids into a MutationTable. Haplotypes are only reconstructed for the rows that are sampled.
+    If counts is given each genotype is a clone of counts[i] identical individuals, laid out consecutively as rows'''
+    def __init__(self, table, genotypes, reference, counts = None):
+        self.table = table
+        self.genotypes = genotypes
+        self.reference = np.asarray(reference)
+        self.counts = counts
+        self.shape = (len(genotypes) if counts is None else int(np.sum(counts)), len(reference))
+
+    def dense(self, rows, cols = None):
+        rows = np.asarray(rows)
+        if self.counts is not None:
+            rows = np.searchsorted(np.cumsum(self.counts), rows, side = 'right')
+        genotypes, inverse = np.unique(self.genotypes[rows], return_inverse = True)
+        return self.table.haplotypes(genotypes, self.reference, cols)[inverse]
+
+    def sample(self, rows):
+        return self.dense(rows)
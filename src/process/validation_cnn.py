@@ -7,8 +7,12 @@ import numpy as np
 import datetime
 import argparse
 import os
+import sys
 import datetime
-from itertools import combinations
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main'))
+from model import loadHaplotypes, sortHaplotypes
+from stats import popgenStats
 
 parser = argparse.ArgumentParser(description = 'Sumstats input and output.')
 parser.add_argument('-dir', '--directory', help='Haplotype directory')
@@ -32,35 +36,6 @@ def mutateStats(haplotypes):
 	mutations_per_alignment = np.sum(haplotypes)	
 	return [average_mutations_per_virus, average_mutations_per_site, mutations_per_alignment]
 
-def popgenStats(haplotypes, n = 200):
-	counts = np.array([i for i in np.sum(haplotypes, axis = 0) if i < 200 and i > 0])
-	# Watterson's estimator
-	S = len(counts)
-	an = np.sum([1/i for i in range(1, n)])
-	theta_w = S / an
-	# Tajima's pi
-	vafs = counts / n
-	d = np.sum(vafs * (1 - vafs)) * (n^2)
-	theta_pi = d / len([j for j in combinations([i for i in range(n)], 2)])
-	# Variance for Tajima's D
-	a1 = np.sum([1/i for i in range(1, n)])
-	a2 = np.sum([1/(i*i) for i in range(1, n)])
-	b1 = (n + 1) / (3 * (n - 1))
-	b2 = (2 * ((n*n) + n + 3)) / (9 * n * (n - 1))
-	c1 = b1 - (1 / a1)
-	c2 = b2 - ((n + 2) / (a1 * n)) + (a2 / (a1*a1))
-	e1 = c1 / a1
-	e2 = c2 / ((a1*a1) + a2)
-	seD = np.sqrt((e1 *S) + ((e2 * S) * (S - 1)))
-	TajimasD = (theta_pi - theta_w) / seD
-	# Fay and Wu's H
-	theta_l = np.sum(vafs) * (n / (n - 1))
-	bn = np.sum([1/(i*i) for i in range(1, n)])
-	bn1 = np.sum([1/(i*i) for i in range(1, n+1)])
-	theta2 = (S * (S - 1)) / ((an*an) + bn)
-	seH = np.sqrt((((n - 2) / (6*(n - 1))) * theta_w) + (theta2 * (((18 * (n*n) * (3 * n + 2) * bn1) - (88 * (n*n*n) + 9 * (n*n) - 13*n + 6))/(9 * n * ((n - 1)*(n-1))))))
-	WuH = 2 * ((theta_pi - theta_l) / seH)
-	return [TajimasD, WuH]
 
 # Organize and save output
 # ------------------------
@@ -81,11 +56,7 @@ count = 1
 for file in os.listdir():
 	print(count)
 	count += 1
-	haplotypes = np.load(file)[0]
-	if SORTING == 'row' or SORTING == 'rowcol':
-		haplotypes = np.array(haplotypes[np.argsort(haplotypes.sum(axis=1))[::-1],:].tolist())
-	if SORTING == 'col' or SORTING == 'rowcol':
-		haplotypes = np.array(haplotypes[:,np.argsort(haplotypes.sum(axis=0))[::-1]].tolist())
+	haplotypes = sortHaplotypes(loadHaplotypes(file)[0], sort_row = SORTING == 'row' or SORTING == 'rowcol', sort_col = SORTING == 'col' or SORTING == 'rowcol')
 	descriptive, sumstats = mutateStats(haplotypes), popgenStats(haplotypes)
 	ids = ids + [file]
 	# Get descriptive data
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+''' Description: This script validates the coalescent sampler for the neutral class against the forward simulator by comparing the site frequency spectrum, Tajima's D and Fay and Wu's H across replicate images '''
+
+import numpy as np
+import pandas as pd
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main'))
+from simulation import simulateViralEvolutionVectorized
+from coalescent import simulateCoalescent
+import model as mod
+from stats import popgenStats
+
+parser = argparse.ArgumentParser(description = 'Coalescent validation parameters')
+parser.add_argument('-n', '--replicates', default = 100, type = int, help='Number of replicate images per sampler.')
+parser.add_argument('-u', '--mutRate', default = 1e-2, type = float, help='Mutation rate')
+parser.add_argument('-gs', '--genomeSize', default = 1000, type = int, help='Genome size (bp)')
+parser.add_argument('-ms', '--maxPopSize', default = 1e5, type = float, help='Maximum population size')
+parser.add_argument('-ims', '--imageSize', default = 200, type = int, help='Number of haplotypes per image.')
+parser.add_argument('-bins', '--bins', default = 10, type = int, help='Number of derived allele frequency bins for the SFS comparison.')
+parser.add_argument('-z', '--tolerance', default = 4, type = float, help='Largest accepted |z| between the mean statistics of the two samplers.')
+parser.add_argument('-out', '--output', default = None, help='Optional csv path for the per-replicate statistics.')
+
+args = parser.parse_args()
+n = args.imageSize
+params = dict(r = 2.02, x = 1, mutRate = args.mutRate, genomeSize = args.genomeSize, initSize = 110, gens = 250, maxPopSize = args.maxPopSize)
+
+def describe(haplotypes):
+    '''Binned unfolded SFS, Tajima's D and Fay and Wu's H of one image'''
+    counts = haplotypes.sum(axis = 0)
+    counts = counts[(counts > 0) & (counts < n)]
+    sfs = np.histogram(counts / n, bins = args.bins, range = (0, 1))[0]
+    return list(sfs) + list(popgenStats(haplotypes, n = n))
+
+records = []
+for sampler in ['forward', 'coalescent']:
+    start_time = time.time()
+    for rep in range(args.replicates):
+        if sampler == 'forward':
+            sim = simulateViralEvolutionVectorized(w = 1, probBen = 0, print_per_gen = -1, seed = rep, genealogy = True, **params)
+            np.random.seed(rep)
+            haplotypes = mod.sampleData(sims = sim, size = n, reps = 1)[0][0]
+        else:
+            haplotypes = simulateCoalescent(size = n, reps = 1, seed = rep, **params)[0][0]
+        records.append([sampler, rep] + describe(haplotypes))
+    print(sampler + ': ' + str(round((time.time() - start_time) / args.replicates, 4)) + ' seconds per image')
+
+columns = ['sampler', 'replicate'] + ['SFS ' + str(i) for i in range(args.bins)] + ['Tajima\'s D', 'Fay and Wu\'s H']
+df = pd.DataFrame(records, columns = columns)
+if args.output is not None:
+    df.to_csv(args.output, index = False)
+
+failed = 0
+print('')
+print('{:16s} {:>10s} {:>10s} {:>8s}'.format('Statistic', 'Forward', 'Coalescent', 'z'))
+for statistic in columns[2:]:
+    a = df[df['sampler'] == 'forward'][statistic].values.astype(float)
+    b = df[df['sampler'] == 'coalescent'][statistic].values.astype(float)
+    se = np.sqrt(a.var(ddof = 1) / len(a) + b.var(ddof = 1) / len(b))
+    z = (a.mean() - b.mean()) / se if se > 0 else (0.0 if a.mean() == b.mean() else np.inf)
+    failed += abs(z) > args.tolerance
+    print('{:16s} {:10.3f} {:10.3f} {:8.2f}'.format(statistic, a.mean(), b.mean(), z))
+
+print('')
+print('Coalescent sampler matches the forward simulator' if failed == 0 else str(failed) + ' statistics differ by more than ' + str(args.tolerance) + ' standard errors')
+sys.exit(int(failed > 0))
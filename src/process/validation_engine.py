@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+''' Description: This script checks that the vectorized and clone-count simulation engines are statistically equivalent to the original object-based engine by comparing replicate distributions of population and haplotype summaries '''
+
+import numpy as np
+import pandas as pd
+import random
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main'))
+from simulation import simulateViralEvolution, simulateViralEvolutionVectorized, simulateViralEvolutionClones
+
+parser = argparse.ArgumentParser(description = 'Engine equivalence parameters')
+parser.add_argument('-n', '--replicates', default = 30, type = int, help='Number of replicate simulations per engine.')
+parser.add_argument('-w', '--fitness', default = 1.2, type = float, help='Fitness (1 + s)')
+parser.add_argument('-p', '--probBen', default = 0.1, type = float, help='Probability of positively selected mutation')
+parser.add_argument('-u', '--mutRate', default = 1e-2, type = float, help='Mutation rate')
+parser.add_argument('-gs', '--genomeSize', default = 1000, type = int, help='Genome size (bp)')
+parser.add_argument('-ms', '--maxPopSize', default = 2e4, type = float, help='Maximum population size')
+parser.add_argument('-ims', '--imageSize', default = 200, type = int, help='Number of haplotypes sampled per replicate.')
+parser.add_argument('-a', '--alpha', default = 0.01, type = float, help='Significance level of the two-sample KS tests.')
+parser.add_argument('-out', '--output', default = None, help='Optional csv path for the per-replicate summaries.')
+
+args = parser.parse_args()
+
+def summarise(sim, size):
+    '''Population and sampled-haplotype summaries of one simulation'''
+    reference = np.array(sim.reference)
+    rows = np.random.choice(sim.mutations.shape[0], size = min(size, sim.mutations.shape[0]), replace = False)
+    haplotypes = (sim.dense(rows) != reference).astype(int)
+    counts = haplotypes.sum(axis = 0)
+    return {'Neutral viruses': sim.numberNeutral, 'Beneficial viruses': sim.numberBeneficial, 'Segregating sites': int(np.sum((counts > 0) & (counts < haplotypes.shape[0]))), 'Mutations per haplotype': haplotypes.sum(axis = 1).mean(), 'Beneficial mutations': len(sim.positiveLoci)}
+
+def ksTest(a, b):
+    '''Two-sample Kolmogorov-Smirnov statistic and asymptotic p-value'''
+    a, b = np.sort(a), np.sort(b)
+    grid = np.concatenate((a, b))
+    D = np.max(np.abs(np.searchsorted(a, grid, side = 'right') / len(a) - np.searchsorted(b, grid, side = 'right') / len(b)))
+    en = np.sqrt(len(a) * len(b) / (len(a) + len(b)))
+    lam = (en + 0.12 + 0.11 / en) * D
+    k = np.arange(1, 101)
+    p = np.clip(2 * np.sum((-1) ** (k - 1) * np.exp(-2 * (k * lam) ** 2)), 0, 1) if lam > 0 else 1.0
+    return (D, p)
+
+ENGINES = {'Object': simulateViralEvolution, 'Vectorized': simulateViralEvolutionVectorized, 'Clone': simulateViralEvolutionClones}
+
+records = []
+for name, engine in ENGINES.items():
+    start_time = time.time()
+    for rep in range(args.replicates):
+        random.seed(rep)
+        np.random.seed(rep)
+        seeded = {} if engine is simulateViralEvolution else {'seed': rep} # The array engines draw from their own generator
+        sim = engine(r = 2.02, w = args.fitness, x = 1, probBen = args.probBen, mutRate = args.mutRate, genomeSize = args.genomeSize, initSize = 110, gens = 250, maxPopSize = args.maxPopSize, print_per_gen = -1, **seeded)
+        records.append(dict(engine = name, replicate = rep, **summarise(sim, args.imageSize)))
+    print(engine.__name__ + ': ' + str(round((time.time() - start_time) / args.replicates, 3)) + ' seconds per simulation')
+
+df = pd.DataFrame(records)
+if args.output is not None:
+    df.to_csv(args.output, index = False)
+
+failed = 0
+for name in list(ENGINES)[1:]:
+    print('')
+    print('{:24s} {:>12s} {:>12s} {:>6s} {:>8s}'.format('Summary', 'Object', name, 'KS D', 'p'))
+    for summary in ['Neutral viruses', 'Beneficial viruses', 'Segregating sites', 'Mutations per haplotype', 'Beneficial mutations']:
+        a = df[df['engine'] == 'Object'][summary].values.astype(float)
+        b = df[df['engine'] == name][summary].values.astype(float)
+        D, p = ksTest(a, b)
+        failed += p < args.alpha
+        print('{:24s} {:12.2f} {:12.2f} {:6.2f} {:8.3f}'.format(summary, a.mean(), b.mean(), D, p))
+
+print('')
+print('Engines are statistically equivalent' if failed == 0 else str(failed) + ' summaries differ at alpha = ' + str(args.alpha))
+sys.exit(int(failed > 0))
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+''' Description: This script checks the fully-convolutional genome scanner (scan.scanConvolutional) against per-window scoring (scan.scanWindows) on random
+haplotypes with an untrained CNN of the trainCNN architecture, for unsorted images and for rows sorted over the whole genome, and compares their throughput '''
+
+import numpy as np
+import argparse
+import math
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main'))
+from model import buildCNN, sortHaplotypes
+from scan import scanWindows, scanConvolutional, agreement
+
+parser = argparse.ArgumentParser(description = 'Convolutional scan agreement parameters')
+parser.add_argument('-gs', '--genomeSize', default = 6000, type = int, help='Genome size (bp)')
+parser.add_argument('-as', '--alignment_size', default = 1000, type = int, help='Window (CNN input) size (bp)')
+parser.add_argument('-n', '--subsamples', default = 2, type = int, help='Number of subsamples')
+parser.add_argument('-tol', '--tolerance', default = 1e-4, type = float, help='Largest accepted absolute score difference')
+
+args = parser.parse_args()
+STEP_SIZE = 50
+BUFFER = 50
+
+# Windows as built in genome.py and slide.py
+steps = [(i*STEP_SIZE)+BUFFER for i in range(0, math.floor(args.genomeSize/STEP_SIZE))]
+steps = [[steps[i], steps[i+1]+(args.alignment_size - STEP_SIZE)] for i in range(len(steps)-1)]
+steps = steps + [[steps[-1][0] + args.genomeSize - steps[-1][1] - BUFFER, steps[-1][1] + args.genomeSize - steps[-1][1] - BUFFER]]
+steps = [i for i in steps if i[1] <= args.genomeSize]
+
+rng = np.random.default_rng(1)
+haplotypes = (rng.random((args.subsamples, 200, args.genomeSize)) < 0.01).astype(np.uint8)
+model = buildCNN(200, args.alignment_size)
+
+failed = 0
+for sort_row in [False, True]:
+    difference = agreement(model, haplotypes, steps, sort_row = sort_row)
+    failed += difference > args.tolerance
+    print('sort_row = ' + str(sort_row) + ': largest score difference ' + str(difference))
+
+images = sortHaplotypes(haplotypes, sort_row = True)
+start_time = time.time()
+scanWindows(model, images, steps)
+windowed = time.time() - start_time
+start_time = time.time()
+scanConvolutional(model, images, steps)
+convolutional = time.time() - start_time
+print('Convolutional scan is ' + str(round(windowed / convolutional, 1)) + 'x faster than per-window scoring')
+
+print('')
+print('Scanners agree' if failed == 0 else 'Scanners differ by more than ' + str(args.tolerance))
+sys.exit(int(failed > 0))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+''' Description: This script checks the batched sorting kernel (model.sortHaplotypes) against the per-image argsort previously used across the pipeline. Orderings must agree on
+the mutation counts everywhere, be identical when there are no ties, and match a stable per-image reference sort exactly '''
+
+import numpy as np
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'main'))
+from model import sortHaplotypes
+
+parser = argparse.ArgumentParser(description = 'Sorting kernel equivalence parameters')
+parser.add_argument('-n', '--images', default = 200, type = int, help='Number of random images per check.')
+parser.add_argument('-nr', '--nrows', default = 200, type = int, help='Number of haplotypes per image.')
+parser.add_argument('-nc', '--ncols', default = 1000, type = int, help='Number of sites per image.')
+parser.add_argument('-seed', '--seed', default = 1, type = int, help='Seed of the random images.')
+
+args = parser.parse_args()
+
+def legacySort(haplotypes, sort_row, sort_col):
+    '''Per-image sort as previously written in sampleData, trainTestData, genome.py, slide.py and validation_cnn.py'''
+    if sort_row == True:
+        haplotypes = np.array(haplotypes[np.argsort(haplotypes.sum(axis=1))[::-1],:].tolist())
+    if sort_col == True:
+        haplotypes = np.array(haplotypes[:,np.argsort(haplotypes.sum(axis=0))[::-1]].tolist())
+    return haplotypes
+
+def stableSort(haplotypes, sort_row, sort_col):
+    '''Per-image reference with explicit stable tie-breaking (Python's sorted is stable)'''
+    if sort_row == True:
+        counts = haplotypes.sum(axis=1, dtype=np.int64)
+        haplotypes = haplotypes[sorted(range(len(counts)), key = lambda i: -counts[i]),:]
+    if sort_col == True:
+        counts = haplotypes.sum(axis=0, dtype=np.int64)
+        haplotypes = haplotypes[:,sorted(range(len(counts)), key = lambda i: -counts[i])]
+    return haplotypes
+
+rng = np.random.default_rng(args.seed)
+# Sparse images have many tied rows and columns; shuffled staircase images have distinct counts along both axes and so no ties
+sparse = (rng.random((args.images, args.nrows, args.ncols)) < rng.uniform(0.001, 0.05, size = (args.images, 1, 1))).astype(np.uint8)
+n = min(args.nrows, args.ncols)
+staircase = np.tril(np.ones((n, n), dtype = np.uint8))
+distinct = np.array([staircase[rng.permutation(n)][:,rng.permutation(n)] for k in range(args.images)])
+
+failed = 0
+for sort_row, sort_col in [(True, False), (False, True), (True, True)]:
+    start_time = time.time()
+    batched = sortHaplotypes(sparse, sort_row, sort_col)
+    kernel_time = time.time() - start_time
+    start_time = time.time()
+    legacy = np.array([legacySort(i, sort_row, sort_col) for i in sparse])
+    legacy_time = time.time() - start_time
+    stable = np.array([stableSort(i, sort_row, sort_col) for i in sparse])
+    checks = {'stable reference': np.array_equal(batched, stable),
+        'row counts': np.array_equal(batched.sum(axis=2), legacy.sum(axis=2)),
+        'column counts': np.array_equal(batched.sum(axis=1), legacy.sum(axis=1)),
+        'no ties': np.array_equal(sortHaplotypes(distinct, sort_row, sort_col), np.array([legacySort(i, sort_row, sort_col) for i in distinct])),
+        'single image': np.array_equal(sortHaplotypes(sparse[0], sort_row, sort_col), batched[0])}
+    failed += sum(not i for i in checks.values())
+    print('sort_row = ' + str(sort_row) + ', sort_col = ' + str(sort_col) + ': ' + ', '.join(k + (' ok' if v else ' FAILED') for (k, v) in checks.items()) + ' (' + str(round(legacy_time / kernel_time, 1)) + 'x faster than per-image sorting)')
+
+print('')
+print('Sorting kernel is equivalent' if failed == 0 else str(failed) + ' checks failed')
+sys.exit(int(failed > 0))